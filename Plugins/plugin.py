@@ -1,8 +1,11 @@
-# plugin.py - Gremlin user plugin to control server.py / server2p.py
+# plugin.py - Gremlin user plugin to control server.py
 # ASCII-only, save as UTF-8.
 
 import os
-import shlex
+import sys
+import select
+import types
+import shutil
 import atexit
 import threading
 import subprocess
@@ -17,158 +20,433 @@ from gremlin.user_plugin import *
 
 PLUGIN_DIR = os.path.dirname(__file__)
 
+# Logger di Gremlin risolto una volta sola (None se non disponibile)
+_gremlin_log = getattr(getattr(gremlin, "util", None), "log", None)
+
+
+def _log(msg):
+    """Logga su Gremlin, con fallback su stdout."""
+    if _gremlin_log is None:
+        print(msg)
+        return
+    try:
+        _gremlin_log(msg)
+    except Exception:
+        print(msg)
+
+
+# Il contenuto della cartella non cambia durante la sessione:
+# il percorso del server viene cercato una sola volta.
+_UNSET = object()
+_SERVER_PATH_CACHE = _UNSET
+
 def _detect_server_path():
-    """Cerca server.py o server2p.py nella cartella del plugin."""
-    candidates = ["server.py", "server2p.py"]
-    for name in candidates:
-        full = os.path.join(PLUGIN_DIR, name)
-        if os.path.isfile(full):
-            return full
-    return None
+    """Cerca server.py nella cartella del plugin.
+
+    server2p.py non è più supportato: legge un solo batch per connessione
+    (fino a riga vuota/EOF) e non applica i comandi della connessione
+    persistente di leds/__init__.py.
+    """
+    global _SERVER_PATH_CACHE
+    if _SERVER_PATH_CACHE is _UNSET:
+        found = None
+        # Una sola lettura della cartella invece di uno stat() per candidato
+        try:
+            with os.scandir(PLUGIN_DIR or ".") as it:
+                names = {e.name for e in it if e.is_file()}
+        except OSError:
+            names = set()
+        if "server.py" in names:
+            found = os.path.join(PLUGIN_DIR, "server.py")
+        _SERVER_PATH_CACHE = found
+    return _SERVER_PATH_CACHE
+
+
+def _resolve_python():
+    """
+    Percorso assoluto del Python da usare per il server, risolto una
+    volta sola: evita la ricerca nel PATH ad ogni avvio.
+    Attenzione: dentro Gremlin sys.executable e' JoystickGremlin.exe,
+    quindi si usa solo come ripiego e solo se non e' un eseguibile "frozen".
+    """
+    found = shutil.which("python")
+    if found:
+        return os.path.abspath(found)
+    if sys.executable and not getattr(sys, "frozen", False):
+        return sys.executable
+    return "python"
 
 
 # IMPORTANTISSIMO: usa il Python di sistema (quello con PyUSB installato)
-DEFAULT_PYTHON = "python"
+DEFAULT_PYTHON = _resolve_python()
 
 # Valori “buoni” per il tuo setup (non esposti in UI)
 FIXED_TX_DELAY_MS = 0          # --tx-delay-ms
 FIXED_REPEAT = 0               # --repeat
 FIXED_MAX_ENTRIES = 4          # --max-entries
+FIXED_UDP_PORT = 8766          # --udp-port (stesso numero della porta TCP),
+                               # solo con "UDP transport" acceso in UI
 
 
 # =========================
 #  Stato processo server
 # =========================
 
-_server_proc = [None]
-_server_lock = threading.Lock()
+# Gremlin puo' ricaricare questo modulo piu' volte (ogni Apply del profilo).
+# Lo stato del processo vive in un modulo fittizio in sys.modules, che
+# sopravvive al reload: la nuova istanza ritrova il server gia' avviato e lo
+# adotta se gli argomenti coincidono, invece di fermarlo e riavviarlo.
+#
+# _state.proc: Popen del server. Le letture sono atomiche sotto il GIL
+#   e non prendono il lock; _state.lock serializza solo le scritture
+#   (prenotazione/pubblicazione in _start_server e lo scambio in _stop_server).
+# _state.pidfd: pidfd del processo server (solo Linux): permette di
+#   attenderne l'uscita con poll() senza cicli di attesa attiva.
+# _state.cfg_key: console nascosta + argomenti (cmd[2:]) con cui e' stato
+#   avviato il server, vedi _cfg_key.
+# _state.stop: _stop_server dell'ultima istanza caricata (per atexit).
+_STATE_KEY = "_solr2_srv_atexit"
+_state = sys.modules.get(_STATE_KEY)
+if _state is None:
+    _state = types.ModuleType(_STATE_KEY)
+    _state.stop = None
+
+    def _atexit_stop(hook=_state):
+        if hook.stop is not None:
+            hook.stop()
+
+    _state.proc = None
+    _state.pidfd = None
+    _state.cfg_key = None
+    _state.lock = threading.Lock()
+    # Segnaposto in _state.proc mentre uno spawn e' in corso (fuori dal lock)
+    _state.STARTING = object()
+
+    atexit.register(_atexit_stop)
+    sys.modules[_STATE_KEY] = _state
+
+_STARTING = _state.STARTING
+
+_HAVE_PIDFD = hasattr(os, "pidfd_open") and sys.platform.startswith("linux")
+
+# STARTUPINFO per la console nascosta (solo Windows), costruito una volta:
+# non cambia tra un avvio e l'altro.
+_SI_HIDE = None
+if os.name == "nt":
+    _SI_HIDE = subprocess.STARTUPINFO()
+    _SI_HIDE.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    _SI_HIDE.wShowWindow = subprocess.SW_HIDE
 
 
 def _is_server_running():
-    with _server_lock:
-        return _server_proc[0] is not None and _server_proc[0].poll() is None
+    p = _state.proc
+    if p is _STARTING:
+        return True
+    return p is not None and p.poll() is None
 
 
-def _build_server_args():
+def _build_server_args(si, idle, udp=False):
     """
     Costruisce SOLO gli argomenti che vogliamo controllare:
     - tx-delay-ms, repeat, max-entries (fissi)
-    - stream-interval-ms, stream-idle-timeout-ms (da UI)
+    - stream-interval-ms, stream-idle-timeout-ms (da UI, letti dal chiamante)
+    - udp-port, solo se `udp` (UI accesa e server che lo supporta)
+    Ritorna direttamente la lista argv (niente split/quoting).
     """
-    args = []
+    args = [
+        # Fissi
+        "--tx-delay-ms", str(FIXED_TX_DELAY_MS),
+        "--repeat", str(FIXED_REPEAT),
+        "--max-entries", str(FIXED_MAX_ENTRIES),
+        # Streaming da UI
+        "--stream-interval-ms", str(si),
+        "--stream-idle-timeout-ms", str(idle),
+    ]
+    if udp:
+        # il server lo apre su 127.0.0.1 (default di --udp-host)
+        args += ["--udp-port", str(FIXED_UDP_PORT)]
+    return args
+
+
+_UDP_SUPPORT_CACHE = {}
+
+def _server_supports_udp(srv_path):
+    """True se il server trovato accetta --udp-port (una copia vecchia di
+    server.py no: argparse la farebbe uscire subito). Letto una volta per file."""
+    supported = _UDP_SUPPORT_CACHE.get(srv_path)
+    if supported is None:
+        try:
+            with open(srv_path, "rb") as f:
+                supported = b"--udp-port" in f.read()
+        except OSError:
+            supported = False
+        _UDP_SUPPORT_CACHE[srv_path] = supported
+    return supported
+
+
+def _int_value(var, default):
+    """Valore intero di una variabile UI (default se mancante/non valido)."""
+    v = getattr(var, "value", default)
+    if isinstance(v, int):
+        return v
+    if v is None:
+        return default
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return default
 
-    # Fissi
-    args.append(f"--tx-delay-ms {FIXED_TX_DELAY_MS}")
-    args.append(f"--repeat {FIXED_REPEAT}")
-    args.append(f"--max-entries {FIXED_MAX_ENTRIES}")
 
-    # Streaming da UI
+def _hide_console():
+    """Valore di "Hide server console" (True se la variabile manca)."""
     try:
-        si = int(stream_interval_ms.value)
-    except Exception:
-        si = 1
+        return bool(hide_window.value)
+    except AttributeError:
+        return True
+
+
+def _cfg_key(cmd, hide):
+    """Configurazione di avvio confrontata per decidere se riavviare: anche
+    la console nascosta conta, non si cambia su un processo gia' avviato."""
+    return (hide, *cmd[2:])
+
+
+def _build_server_cmd():
+    """
+    Costruisce la riga di comando completa del server, o None se
+    server.py non si trova.
+    """
+    srv_path = _detect_server_path()
+    if not srv_path:
+        msg = (
+            "[SOLR2-SRV] Nessun server trovato. "
+            "Metti server.py nella stessa cartella del plugin."
+        )
+        _log(msg)
+        return None
+
+    # Variabili UI lette una sola volta, al momento dell'avvio
+    si = _int_value(stream_interval_ms, 1)
+    idle = _int_value(stream_idle_timeout_ms, 3000)
     try:
-        idle = int(stream_idle_timeout_ms.value)
-    except Exception:
-        idle = 3000
+        udp = bool(udp_transport.value)
+    except AttributeError:
+        udp = False
+    if udp and not _server_supports_udp(srv_path):
+        _log("[SOLR2-SRV] Il server trovato non supporta --udp-port: UDP disattivato.")
+        udp = False
 
-    args.append(f"--stream-interval-ms {si}")
-    args.append(f"--stream-idle-timeout-ms {idle}")
+    py_path = DEFAULT_PYTHON
+    srv_args = _build_server_args(si, idle, udp)
 
-    return " ".join(args)
+    return [py_path, srv_path, *srv_args]
 
 
-def _start_server():
+def _start_server(cmd=None):
     """
-    Avvia server.py/server2p.py se non è già in esecuzione.
+    Avvia server.py se non è già in esecuzione.
     Chiamata solo se "Server on" è True.
+
+    Il lock viene tenuto solo per "prenotare" lo slot con _STARTING e poi
+    per pubblicare il Popen: lo spawn vero e proprio avviene fuori dal lock.
     """
-    with _server_lock:
-        if _server_proc[0] is not None and _server_proc[0].poll() is None:
-            try:
-                gremlin.util.log("[SOLR2-SRV] Server già in esecuzione.")
-            except Exception:
-                pass
+    old_proc = old_pidfd = None
+    with _state.lock:
+        cur = _state.proc
+        if cur is _STARTING or (cur is not None and cur.poll() is None):
+            _log("[SOLR2-SRV] Server già in esecuzione.")
             return
+        # Processo precedente gia' uscito: lo raccogliamo prima di riavviare
+        if cur is not None:
+            old_proc, old_pidfd = cur, _state.pidfd
+        _state.proc = _STARTING
+        _state.pidfd = None
+        _state.cfg_key = None
+
+    if old_proc is not None:
+        _reap_server(old_proc, old_pidfd)
+
+    if cmd is None:
+        cmd = _build_server_cmd()
+    if cmd is None:
+        _release_starting()
+        return
 
-        srv_path = _detect_server_path()
-        if not srv_path:
-            msg = (
-                "[SOLR2-SRV] Nessun server trovato. "
-                "Metti server.py o server2p.py nella stessa cartella del plugin."
-            )
-            try:
-                gremlin.util.log(msg)
-            except Exception:
-                print(msg)
-            return
+    # Gestione finestra console
+    creationflags = 0
+    startupinfo = None
+    stdout_target = subprocess.DEVNULL
+    stderr_target = subprocess.DEVNULL
+
+    hide = _hide_console()
+
+    if hide:
+        # Nasconde la finestra su Windows: niente console (ne' conhost)
+        # e, per sicurezza, finestra iniziale nascosta.
+        if os.name == "nt":
+            creationflags = subprocess.CREATE_NO_WINDOW
+            startupinfo = _SI_HIDE
+    else:
+        # Mostra la console se possibile
+        stdout_target = None
+        stderr_target = None
+
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            creationflags=creationflags,
+            startupinfo=startupinfo,
+            # Non ereditare gli handle aperti da Gremlin (HID/USB...).
+            # Su POSIX i descrittori Python sono gia' non ereditabili
+            # (PEP 446): close_fds=False, insieme a niente preexec_fn /
+            # cwd / start_new_session e stdio DEVNULL o ereditato, rende
+            # la chiamata idonea al percorso os.posix_spawn (vfork+exec)
+            # di subprocess invece di fork()+exec(). Non aggiungere
+            # questi parametri senza motivo.
+            close_fds=(os.name == "nt"),
+            stdout=stdout_target,
+            stderr=stderr_target,
+        )
+    except Exception as e:
+        _release_starting()
+        _log(f"[SOLR2-SRV] Errore avvio server: {e}")
+        return
+
+    pidfd = None
+    if _HAVE_PIDFD:
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except OSError:
+            pidfd = None
+
+    with _state.lock:
+        published = _state.proc is _STARTING
+        if published:
+            _state.pidfd = pidfd
+            _state.cfg_key = _cfg_key(cmd, hide)
+            _state.proc = proc
+
+    if not published:
+        # Nel frattempo qualcuno ha chiamato _stop_server: chiudiamo il figlio
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+        _reap_server(proc, pidfd)
+        _log("[SOLR2-SRV] Avvio annullato (stop richiesto durante lo spawn).")
+        return
 
-        py_path = DEFAULT_PYTHON
-        srv_args = _build_server_args()
+    # gremlin.util.log accetta solo una stringa gia' pronta:
+    # list2cmdline evita il repr() elemento per elemento della lista
+    _log("[SOLR2-SRV] Avvio server: " + subprocess.list2cmdline(cmd))
 
-        cmd = [py_path, srv_path] + shlex.split(srv_args, posix=False)
 
-        # Gestione finestra console
-        creationflags = 0
-        stdout_target = subprocess.DEVNULL
-        stderr_target = subprocess.DEVNULL
+def _release_starting():
+    """Libera lo slot prenotato da _start_server se l'avvio fallisce."""
+    with _state.lock:
+        if _state.proc is _STARTING:
+            _state.proc = None
 
-        hide = False
+
+def _wait_server(proc, pidfd, timeout_ms):
+    """
+    Attende al massimo `timeout_ms` che il processo termini.
+    Con pidfd (Linux) il kernel ci sveglia all'uscita del figlio,
+    altrimenti si ricade su Popen.wait(). Ritorna True se e' uscito.
+    """
+    if pidfd is not None:
         try:
-            hide = bool(hide_window.value)
-        except Exception:
-            hide = True
+            p = select.poll()
+            p.register(pidfd, select.POLLIN)
+            if not p.poll(timeout_ms):
+                return False
+        except OSError:
+            pass
+        # Il figlio e' uscito: raccoglie lo stato senza bloccare a lungo
+    try:
+        proc.wait(timeout=timeout_ms / 1000.0)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
 
-        if hide:
-            # Nasconde la finestra su Windows
-            if os.name == "nt":
-                creationflags = 0x08000000  # CREATE_NO_WINDOW
-        else:
-            # Mostra la console se possibile
-            stdout_target = None
-            stderr_target = None
 
+def _reap_server(proc, pidfd=None, timeout_ms=5000):
+    """
+    Attende la fine del processo (kill() se non esce entro `timeout_ms`)
+    e chiude pidfd ed eventuali pipe, cosi' non restano handle aperti
+    tra un avvio e l'altro del server.
+    """
+    try:
+        if not _wait_server(proc, pidfd, timeout_ms):
+            proc.kill()
+            proc.wait()
+    except Exception:
+        pass
+    if pidfd is not None:
         try:
-            _server_proc[0] = subprocess.Popen(
-                cmd,
-                creationflags=creationflags,
-                stdout=stdout_target,
-                stderr=stderr_target,
-            )
+            os.close(pidfd)
+        except OSError:
+            pass
+    for stream in (proc.stdin, proc.stdout, proc.stderr):
+        if stream is not None:
             try:
-                gremlin.util.log(f"[SOLR2-SRV] Avvio server: {cmd}")
+                stream.close()
             except Exception:
-                print("[SOLR2-SRV] Avvio server:", cmd)
-        except Exception as e:
-            try:
-                gremlin.util.log(f"[SOLR2-SRV] Errore avvio server: {e}")
-            except Exception:
-                print("[SOLR2-SRV] Errore avvio server:", e)
+                pass
 
 
 def _stop_server():
     """
-    Termina server.py/server2p.py se in esecuzione.
+    Termina server.py se in esecuzione.
     Viene richiamato:
     - quando il profilo / plugin viene fermato (atexit)
     - se "Server on" è False quando il plugin viene caricato/applicato
     """
-    with _server_lock:
-        if _server_proc[0] is not None and _server_proc[0].poll() is None:
-            try:
-                _server_proc[0].terminate()
-                try:
-                    gremlin.util.log("[SOLR2-SRV] Server terminato.")
-                except Exception:
-                    pass
-            except Exception:
-                pass
-        _server_proc[0] = None
+    # Sotto lock solo lo scambio; terminate/wait avvengono fuori.
+    # Timeout sul lock: in chiusura dell'interprete (atexit) un altro
+    # thread potrebbe tenerlo (thread bloccato/terminato); meglio uno stato
+    # "sporco" che restare bloccati.
+    locked = _state.lock.acquire(timeout=2.0)
+    try:
+        proc, pidfd = _state.proc, _state.pidfd
+        _state.proc = None
+        _state.pidfd = None
+        _state.cfg_key = None
+    finally:
+        if locked:
+            _state.lock.release()
+    if proc is None or proc is _STARTING:
+        # _STARTING: sara' _start_server a chiudere il processo appena creato
+        return
+    if proc.poll() is None:
+        try:
+            proc.terminate()
+            _log("[SOLR2-SRV] Server terminato.")
+        except Exception:
+            pass
+    _reap_server(proc, pidfd)
 
 
-# Quando Gremlin chiude il profilo / esce,
-# viene chiamato atexit -> chiudiamo il server.
-atexit.register(_stop_server)
+def _restart_if_needed(new_cmd):
+    """
+    Non fa nulla se il server e' attivo con gli stessi argomenti;
+    altrimenti lo (ri)avvia con `new_cmd`.
+    """
+    if _is_server_running():
+        if _state.cfg_key == _cfg_key(new_cmd, _hide_console()):
+            # anche dopo un reload del modulo: il server resta quello avviato
+            return
+        _log("[SOLR2-SRV] Configurazione cambiata, riavvio server.")
+        _stop_server()
+    _start_server(new_cmd)
+
+
+# Quando Gremlin chiude il profilo / esce, viene chiamato atexit -> chiudiamo
+# il server. L'hook e' registrato una sola volta per interprete (vedi _state)
+# e chiama sempre lo _stop_server dell'ultima istanza caricata; il server
+# dell'istanza precedente non viene fermato qui: _sync_server_state lo adotta
+# o lo riavvia se la configurazione e' cambiata.
+_state.stop = _stop_server
 
 
 def _sync_server_state():
@@ -176,7 +454,8 @@ def _sync_server_state():
     Sincronizza lo stato del processo con la checkbox "Server on".
 
     - Se Server on = False -> spegni il server (se acceso).
-    - Se Server on = True  -> assicurati che sia acceso.
+    - Se Server on = True  -> assicurati che sia acceso, riavviandolo solo
+      se gli argomenti sono cambiati rispetto all'istanza in esecuzione.
     """
     try:
         on = bool(server_on.value)
@@ -188,9 +467,40 @@ def _sync_server_state():
         _stop_server()
         return
 
-    # Se deve essere acceso, lo avviamo se non è già running.
-    if not _is_server_running():
-        _start_server()
+    # Se deve essere acceso, lo avviamo (o riavviamo se la config e' cambiata).
+    cmd = _build_server_cmd()
+    if cmd is not None:
+        _restart_if_needed(cmd)
+
+
+# Serializza le sincronizzazioni, anche tra istanze diverse del modulo
+# (in _state, sopravvive al reload). sync_seq numera le richieste: una sync
+# superata da una piu' recente mentre aspettava il lock non fa nulla.
+if not hasattr(_state, "sync_lock"):
+    _state.sync_lock = threading.Lock()
+    _state.sync_seq = 0
+
+
+def _sync_worker(seq):
+    with _state.sync_lock:
+        if seq != _state.sync_seq:
+            return
+        try:
+            _sync_server_state()
+        except Exception as e:
+            _log(f"[SOLR2-SRV] Errore in _sync_server_state: {e}")
+
+
+def _sync_server_state_async():
+    """
+    Esegue _sync_server_state su un thread a parte, cosi' il caricamento
+    del plugin non resta bloccato durante lo spawn del server ne' durante
+    lo stop (fino a 5 s) di un server da riavviare. L'attesa di una
+    sincronizzazione precedente avviene anch'essa sul thread a parte.
+    """
+    _state.sync_seq += 1
+    threading.Thread(target=_sync_worker, args=(_state.sync_seq,),
+                     name="solr2-sync", daemon=True).start()
 
 
 # =========================
@@ -219,6 +529,13 @@ stream_idle_timeout_ms = IntegerVariable(
     60000,
 )
 
+udp_transport = BoolVariable(
+    "UDP transport",
+    "Apre anche il listener UDP locale (127.0.0.1): serve alle azioni con "
+    "Trasporto UDP, che altrimenti non arrivano al server.",
+    False,
+)
+
 hide_window = BoolVariable(
     "Hide server console (Windows only)",
     "Nasconde la finestra console del server.",
@@ -231,9 +548,6 @@ hide_window = BoolVariable(
 # =========================
 
 try:
-    _sync_server_state()
+    _sync_server_state_async()
 except Exception as e:
-    try:
-        gremlin.util.log(f"[SOLR2-SRV] Errore in _sync_server_state: {e}")
-    except Exception:
-        print("[SOLR2-SRV] Errore in _sync_server_state:", e)
+    _log(f"[SOLR2-SRV] Errore in _sync_server_state: {e}")
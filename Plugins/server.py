@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-server2p.py — SOL-R2 light server (INDEX header, alias) + timing controls
+server.py — SOL-R2 light server (INDEX header, alias) + timing controls
 
 Aggiunte:
 - --tx-delay-ms <ms> : attende tra i pacchetti per device (default 0)
 - --repeat <n>       : ripete l'invio di ogni pacchetto n volte (default 1)
 - --usb-timeout-ms   : timeout di write USB (default 1000)
 - --max-entries <m>  : max (ADDR,R,G,B) per pacchetto (default 15 -> 4+4*m <= 64)
+- --bulk-chunk-size <b> : unisce pacchetti pieni da 64B in una sola write bulk
+                          fino a <b> byte (default 1 MiB, 0 = disattiva)
+- --rcvbuf / --sndbuf <b> : SO_RCVBUF/SO_SNDBUF del socket TCP (default 1 MiB, 0 = OS)
+- --coalesce-ms <ms>  : raccoglie per <ms> i comandi di più connessioni in pacchetti
+                       comuni prima dell'invio USB (default 0 = disattiva; con >0
+                       il percorso send_one non si usa e lo streaming scrive
+                       fuori dalla coda di coalescenza)
+- --udp-port <p>      : accetta gli stessi comandi anche via UDP su <p>, un batch
+                       di righe per datagramma e nessuna risposta (default 0 = off)
+- --udp-host <h>      : indirizzo del listener UDP (default 127.0.0.1: senza
+                       connessione né risposta, meglio non esporlo in rete)
 
 Mantiene:
 - Formato pacchetto: INDEX(4) + (ADDR,R,G,B)*N
@@ -24,13 +35,15 @@ Estensioni effetti:
   BLINK: colore ON/OFF ogni <ms> (mezzo periodo)
   FADE : fade in/out continuo sul colore indicato con periodo <ms>
   RAINBOW: ciclo di tinta (hue) HSV con periodo <ms> (luminosità dal colore base)
+- Suffisso opzionale "AFTER <ms>" su qualunque riga: la riga viene applicata
+  <ms> millisecondi dopo la ricezione (usato dal modo SEQ del client per
+  inviare l'intera sequenza in un solo batch), es. "LED2 255 0 0 AFTER 100".
 - Per fermare un effetto: invia un comando senza effetto sullo stesso LED,
   es. "LED1 0 0 0" oppure "LED1 0 255 0".
 """
 
-import argparse, json, socketserver, threading, time, traceback
-from typing import Dict, Tuple, List, Optional
-import colorsys
+import argparse, array, collections, heapq, itertools, json, re, socket, socketserver, struct, sys, threading, time, traceback
+from typing import Dict, Tuple, List, Optional, Set
 
 # --------------------- Config ---------------------
 VID = 0x044F
@@ -38,9 +51,22 @@ PID_RIGHT = 0x0422
 PID_LEFT  = 0x042A
 USB_INTERFACE_DEFAULT = 1
 USB_EP_OUT_DEFAULT    = 0x02
+USB_MAX_PACKET        = 64        # wMaxPacketSize dell'endpoint bulk OUT
+BULK_CHUNK_SIZE_DEFAULT = 1 << 20 # max byte per singola write coalescente
+TX_BUF_MAX            = 4096      # write fino a questa dimensione usano buffer preallocati
+TX_QUEUE_MAX          = 32        # write in coda per device oltre cui si fondono (ultimo valore vince)
 
 LISTEN_HOST_DEFAULT   = "0.0.0.0"
 LISTEN_PORT_DEFAULT   = 8766
+UDP_HOST_DEFAULT      = "127.0.0.1"  # listener UDP solo in loopback
+
+# Risposte fisse del protocollo TCP (evitano json.dumps nel caso comune)
+OK_RESPONSE = b'{"ok": true}\n'
+NO_COMMANDS = b'{"ok": false, "error": "no commands"}\n'
+RECV_BUFSIZE = 65536   # byte per singola recv() del Handler
+SOCK_BUF_DEFAULT = 1 << 20   # SO_RCVBUF/SO_SNDBUF del socket in ascolto (0 = default OS)
+COALESCE_MS_DEFAULT = 0.0    # finestra di coalescenza USB tra connessioni (0 = disattiva, opt-in)
+UDP_MAX_DATAGRAM = 65535     # byte massimi letti per datagramma dal listener UDP
 
 # --------------------- MAP integrata ---------------------
 EMBED_MAP: Dict[str, Tuple[str, str]] = {
@@ -103,9 +129,30 @@ GROUP_ALIASES = {
     "LED9":  ["LED9A","LED9B","LED9C","LED9D","LED9E","LED9F","LED9G","LED9H"],
     "LED10": ["LED10A","LED10B","LED10C"],
 }
-def expand_leds(led_name: str) -> List[str]:
+# Espansioni precalcolate per tutti i nomi noti (LED singoli + gruppi)
+EXPANDED: Dict[str, Tuple[str, ...]] = {k: (k,) for k in LED_MAP.keys()}
+EXPANDED.update({k: tuple(v) for k, v in GROUP_ALIASES.items()})
+
+# (ADDR, INDEX) per ogni LED, risolti una volta sola
+ADDR_IDX: Dict[str, Tuple[int, bytes]] = {name: LED_MAP.get(name) for name in LED_MAP.keys()}
+
+# INDEX distinti di LED_MAP, numerati per i bucket di pack_by_index
+IDX_LIST: Tuple[bytes, ...] = tuple(dict.fromkeys(idx for _addr, idx in ADDR_IDX.values()))
+IDX_TO_ID: Dict[bytes, int] = {idx: i for i, idx in enumerate(IDX_LIST)}
+
+# (ADDR, R, G, B) -> 4 byte, via struct senza passare da una tupla/lista
+_S_BBBB = struct.Struct("BBBB").pack
+
+# Pacchetto singolo precompilato per LED: INDEX(4) + ADDR + R,G,B a zero
+LED_TEMPLATE: Dict[str, bytes] = {name: idx + bytes((addr, 0, 0, 0))
+                                  for name, (addr, idx) in ADDR_IDX.items()}
+
+def expand_leds(led_name: str) -> Tuple[str, ...]:
+    exp = EXPANDED.get(led_name)
+    if exp is not None:
+        return exp
     key = led_name.upper()
-    return GROUP_ALIASES.get(key, [key])
+    return EXPANDED.get(key, (key,))
 
 # --------------------- USB backend ---------------------
 try:
@@ -118,12 +165,110 @@ except Exception:
     HAVE_USB = False
 
 class USBDevice:
-    def __init__(self, vid: int, pid: int, name: str, interface: int, ep_out: int, timeout_ms: int, dry_run: bool = False, debug: bool=False):
+    def __init__(self, vid: int, pid: int, name: str, interface: int, ep_out: int, timeout_ms: int, dry_run: bool = False, debug: bool=False,
+                 max_entries: int = 15):
         self.vid = vid; self.pid = pid; self.name = name
         self.intf = interface; self.ep = ep_out
         self.lock = threading.Lock(); self.dev = None
+        self._dev_write = None
         self.timeout_ms = timeout_ms
         self.dry_run = dry_run; self.debug = debug
+        # buffer di trasmissione per dimensione (<= TX_BUF_MAX), usati solo
+        # dal thread writer: size -> (array('B'), memoryview sullo stesso)
+        self._tx_bufs: Dict[int, Tuple[array.array, memoryview]] = {}
+        # prefisso dei log di write, calcolato una volta sola
+        self._log_prefix = f"[USB:{'DRY:' if dry_run else ''}{name}]"
+        # Coda verso il thread writer: (packets, repeat, tx_delay_ms). Oltre
+        # TX_QUEUE_MAX (device bloccato sui timeout) le write in attesa vengono
+        # fuse per (INDEX, ADDR): niente crescita senza limite né replay di
+        # frame vecchi alla ripresa. _q_lock serializza i produttori.
+        self.tx_queue: "collections.deque[Tuple[List[bytes], int, int]]" = collections.deque()
+        self._q_lock = threading.Lock()
+        self.max_entries = max_entries
+        self.wake = threading.Event()
+        self._tx_stop = False
+        self._tx_thread: Optional[threading.Thread] = None
+
+    def start_writer(self):
+        """Avvia il thread che svuota tx_queue scrivendo sul device."""
+        if self._tx_thread is not None:
+            return
+        self._tx_stop = False
+        self._tx_thread = threading.Thread(target=self._tx_loop, name=f"usb-tx-{self.name}", daemon=True)
+        self._tx_thread.start()
+
+    def stop_writer(self, timeout: float = 1.0):
+        """Ferma il thread writer dopo aver svuotato la coda."""
+        t = self._tx_thread
+        if t is None:
+            return
+        self._tx_stop = True
+        self.wake.set()
+        t.join(timeout=timeout)
+        self._tx_thread = None
+
+    def enqueue(self, packets: List[bytes], repeat: int = 1, tx_delay_ms: int = 0):
+        """
+        Accoda i pacchetti per il thread writer e ritorna subito.
+        Senza writer attivo (es. prima di start_writer) scrive in modo sincrono.
+        """
+        if self._tx_thread is None:
+            self.write_many(packets, repeat, tx_delay_ms)
+            return
+        q = self.tx_queue
+        with self._q_lock:
+            if len(q) >= TX_QUEUE_MAX:
+                self._collapse_queue()
+            q.append((packets, repeat, tx_delay_ms))
+        self.wake.set()
+
+    def _collapse_queue(self):
+        """
+        Fonde le write in coda in un solo gruppo di pacchetti: per ogni
+        (INDEX, ADDR) resta l'ultimo colore. Chiamata con _q_lock preso; il
+        writer può intanto togliere solo l'elemento più vecchio, quindi
+        l'ordine resta quello di arrivo.
+        """
+        q = self.tx_queue
+        latest: Dict[Tuple[bytes, int], bytes] = {}
+        total = 0
+        repeat, tx_delay_ms = 1, 0
+        while q:
+            try:
+                packets, repeat, tx_delay_ms = q.popleft()
+            except IndexError:
+                break  # l'ultimo l'ha preso il writer
+            for data in packets:
+                # una write può contenere più pacchetti da USB_MAX_PACKET
+                # concatenati (coalesce_packets): tutti pieni tranne l'ultimo
+                for off in range(0, len(data), USB_MAX_PACKET):
+                    frame = bytes(data[off:off + USB_MAX_PACKET])
+                    idx = frame[:4]
+                    for j in range(4, len(frame) - 3, 4):
+                        latest[(idx, frame[j])] = frame[j:j + 4]
+                        total += 1
+        if not latest:
+            return
+        q.append((pack_by_index([(idx, argb) for (idx, _addr), argb in latest.items()],
+                                max_entries=self.max_entries), repeat, tx_delay_ms))
+        if self.debug:
+            print(f"{self._log_prefix} coda piena: scartate {total - len(latest)} entry superate")
+
+    def _tx_loop(self):
+        q = self.tx_queue
+        wake = self.wake
+        while True:
+            wake.wait()
+            wake.clear()
+            # deque.popleft è atomica: nessun lock tra Handler/stream e writer
+            while q:
+                packets, repeat, tx_delay_ms = q.popleft()
+                try:
+                    self.write_many(packets, repeat, tx_delay_ms)
+                except Exception:
+                    traceback.print_exc()
+            if self._tx_stop:
+                return
 
     def open(self):
         if self.dry_run:
@@ -144,6 +289,8 @@ class USBDevice:
         except Exception:
             pass
         usb_util.claim_interface(self.dev, self.intf)
+        # metodo di scrittura risolto una volta sola
+        self._dev_write = self.dev.write
         print(f"[USB] {self.name} aperto su IF={self.intf}, EP_OUT=0x{self.ep:02X}, timeout={self.timeout_ms}ms")
 
     def close(self):
@@ -155,15 +302,60 @@ class USBDevice:
         except Exception:
             pass
 
+    def _log_write(self, data: bytes):
+        print(f"{self._log_prefix} ({len(data)}B) {data.hex(' ').upper()}")
+
     def write(self, data: bytes):
-        if self.dry_run or self.debug:
-            print(f"[USB:{'DRY:' if self.dry_run else ''}{self.name}] ({len(data)}B) {data.hex(' ').upper()}")
         if self.dry_run:
+            self._log_write(data)
             return
-        n = self.dev.write(self.ep, data, timeout=self.timeout_ms)
+        if self.debug:
+            self._log_write(data)
+        n = self._dev_write(self.ep, data, timeout=self.timeout_ms)
         if n != len(data):
             raise IOError(f"{self.name}: scritto {n}/{len(data)} bytes")
 
+    def write_many(self, packets: List[bytes], repeat: int = 1, tx_delay_ms: int = 0):
+        """
+        Scrive una sequenza di pacchetti, ognuno `repeat` volte.
+        Ogni pacchetto viene copiato una sola volta in un array('B'), il
+        formato che PyUSB passa al backend senza ulteriori copie, e
+        riutilizzato per tutte le ripetizioni. Fino a TX_BUF_MAX byte
+        l'array è preallocato per dimensione e riempito via memoryview.
+        """
+        delay_s = tx_delay_ms / 1000.0
+        if self.dry_run or self.debug:
+            # Percorso con log (formattazione hex solo qui)
+            for p in packets:
+                for _ in range(repeat):
+                    self.write(p)
+                if delay_s > 0:
+                    time.sleep(delay_s)
+            return
+
+        write = self._dev_write
+        ep, timeout = self.ep, self.timeout_ms
+        tx_bufs = self._tx_bufs
+        for p in packets:
+            size = len(p)
+            if size <= TX_BUF_MAX:
+                # buffer riutilizzato per questa dimensione: PyUSB passa un
+                # array('B') al backend così com'è, niente allocazioni
+                slot = tx_bufs.get(size)
+                if slot is None:
+                    arr = array.array("B", bytes(size))
+                    slot = tx_bufs[size] = (arr, memoryview(arr))
+                buf, view = slot
+                view[:] = p
+            else:
+                buf = array.array("B", p)
+            for _ in range(repeat):
+                n = write(ep, buf, timeout=timeout)
+                if n != size:
+                    raise IOError(f"{self.name}: scritto {n}/{size} bytes")
+            if delay_s > 0:
+                time.sleep(delay_s)
+
 # --------------------- Util ---------------------
 def parse_command_line(line: str) -> Tuple[Optional[str], str, int, int, int]:
     raw = line.strip("\r\n")
@@ -215,30 +407,116 @@ def strip_effect_suffix(raw: str) -> Tuple[str, Optional[str], int]:
     return raw, None, 0
 
 
+# Riga completa in un solo match:
+#   [left:|right:]LEDx R G B [BLINK|FADE|RAINBOW <ms>] [AFTER <ms>]
+# (virgolette esterne e separatori ","/spazi come in parse_command_line)
+CMD_RE = re.compile(
+    r'^\s*(?P<q>"?)\s*(?:(?P<side>left|right):)?[\s,]*(?P<led>[^\s,"]+)'
+    r'[\s,]+(?P<r>[+-]?\d+)[\s,]+(?P<g>[+-]?\d+)[\s,]+(?P<b>[+-]?\d+)'
+    r'(?:[\s,]+(?P<mode>BLINK|FADE|RAINBOW)[\s,]+(?P<ms>\d+))?'
+    r'(?:[\s,]+AFTER[\s,]+(?P<after>\d+))?[\s,]*(?P=q)\s*$',
+    re.IGNORECASE,
+)
+# Stringhe degli effetti internate: il confronto del mode diventa per identità
+EFFECT_MODES: Dict[str, str] = {m: sys.intern(m) for m in ("BLINK", "FADE", "RAINBOW")}
+
+
+def parse_line(line: str) -> Tuple[Optional[str], str, int, int, int, Optional[str], int, int]:
+    """
+    Parsing di una riga comando con CMD_RE:
+        (side, led_name, r, g, b, effetto|None, periodo_ms, after_ms)
+    after_ms > 0 chiede di applicare la riga dopo after_ms millisecondi.
+    Le righe che la regex non riconosce passano dal percorso storico
+    strip_effect_suffix + parse_command_line, che produce gli stessi
+    messaggi d'errore.
+    """
+    m = CMD_RE.match(line)
+    if m is None:
+        core_line, mode, period_ms = strip_effect_suffix(line)
+        return parse_command_line(core_line) + (mode, period_ms, 0)
+    side, led, rs, gs, bs, mode, ms, after = m.group("side", "led", "r", "g", "b", "mode", "ms", "after")
+    r, g, b = int(rs), int(gs), int(bs)
+    if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
+        raise ValueError("R,G,B devono essere tra 0..255")
+    if side is not None:
+        side = side.lower()
+    after_ms = int(after) if after is not None else 0
+    if mode is not None:
+        return side, led.upper(), r, g, b, EFFECT_MODES[mode.upper()], int(ms), after_ms
+    return side, led.upper(), r, g, b, None, 0, after_ms
+
+
 def build_entry(led_name: str, r: int, g: int, b: int) -> Tuple[bytes, bytes]:
-    addr, idx = LED_MAP.get(led_name)
-    return idx, bytes([addr, r, g, b])
+    try:
+        addr, idx = ADDR_IDX[led_name]
+    except KeyError:
+        addr, idx = LED_MAP.get(led_name)
+    return idx, _S_BBBB(addr, r, g, b)
 
 def pack_by_index(entries: List[Tuple[bytes, bytes]], max_entries: int) -> List[bytes]:
     """
     Raggruppa per INDEX e crea pacchetti: INDEX4 + (ADDR,R,G,B)*n, con n<=max_entries,
     cosi' ogni pacchetto resta entro 4 + 4*n <= 64.
     """
-    from collections import defaultdict
-    groups: Dict[bytes, List[bytes]] = defaultdict(list)
+    # un bucket fisso per ogni INDEX noto; gli INDEX sconosciuti (non
+    # previsti da LED_MAP) finiscono in un dict a parte
+    buckets: List[List[bytes]] = [[] for _ in IDX_LIST]
+    extra: Dict[bytes, List[bytes]] = {}
+    id_get = IDX_TO_ID.get
     for idx, argb in entries:
-        groups[idx].append(argb)
+        i = id_get(idx)
+        if i is None:
+            extra.setdefault(idx, []).append(argb)
+        else:
+            buckets[i].append(argb)
 
     packets: List[bytes] = []
-    for idx, lst in groups.items():
+    for idx, lst in (*zip(IDX_LIST, buckets), *extra.items()):
         i = 0
-        while i < len(lst):
-            n = min(max_entries, len(lst) - i)
-            chunk = idx + b"".join(lst[i:i+n])
-            packets.append(chunk)
+        total = len(lst)
+        while i < total:
+            n = min(max_entries, total - i)
+            # scrittura diretta in un buffer della dimensione finale,
+            # senza slice della lista ne' join intermedi
+            buf = bytearray(4 + 4 * n)
+            buf[0:4] = idx
+            off = 4
+            for j in range(i, i + n):
+                buf[off:off + 4] = lst[j]
+                off += 4
+            packets.append(bytes(buf))
             i += n
     return packets
 
+def coalesce_packets(packets: List[bytes], chunk_size: int,
+                     frame_size: int = USB_MAX_PACKET) -> List[bytes]:
+    """
+    Unisce pacchetti consecutivi in un'unica write bulk, senza cambiare
+    quello che arriva al device: un trasferimento bulk viene spezzato in
+    pacchetti da `frame_size` byte e termina al primo pacchetto corto.
+    Quindi si possono concatenare solo pacchetti pieni (== frame_size),
+    e un pacchetto corto puo' stare solo in coda al gruppo.
+    chunk_size <= 0 disattiva la coalescenza.
+    """
+    if chunk_size <= 0 or len(packets) < 2:
+        return packets
+    out: List[bytes] = []
+    cur: List[bytes] = []
+    cur_len = 0
+    for p in packets:
+        if cur and cur_len + len(p) > chunk_size:
+            out.append(b"".join(cur))
+            cur, cur_len = [], 0
+        cur.append(p)
+        cur_len += len(p)
+        if len(p) != frame_size:
+            # pacchetto corto: chiude il trasferimento
+            out.append(b"".join(cur))
+            cur, cur_len = [], 0
+    if cur:
+        out.append(b"".join(cur))
+    return out
+
 # --------------------- Stato LED e loop di streaming (vecchia versione, non usata) ---------------------
 class LEDStateOld:
     """
@@ -276,62 +554,128 @@ class LEDStateOld:
 
 
 # --------------------- Stato LED e streaming opzionale (versione attuale con priorità + effetti) ---------------------
+# Lati dei pannelli: l'indice è la riga nelle strutture per lato
+SIDES: Tuple[str, ...] = ("left", "right")
+SIDE_IDX: Dict[str, int] = {s: i for i, s in enumerate(SIDES)}
+
+# Priorità dei comandi: gli effetti non sovrascrivono un colore statico
+PRIO_EFFECT = 1   # BLINK / FADE / RAINBOW
+PRIO_STATIC = 2   # colore fisso (può sovrascrivere gli effetti)
+
+
 class LEDState:
     """
     Mantiene lo stato corrente di ogni LED per lato, con una nozione di priorità.
-    _state[(side, led_name)] = (r, g, b, priority)
+
+    Layout "structure of arrays": una lista per lato e per campo, indicizzata
+    con la posizione del LED in _names (_led_idx[name] -> i):
+        _rgb[SIDE_IDX[side]][i]  = (r, g, b)
+        _prio[SIDE_IDX[side]][i] = priority
+    Così i controlli per cella sono accessi a lista, senza dict a chiave
+    composta.
+
+    `version` cresce a ogni update accettato e _changed raccoglie le celle
+    (si, i) toccate: lo stream_worker legge solo quelle con drain_changes().
     """
 
     def __init__(self, led_names: Optional[List[str]] = None):
         self._lock = threading.Lock()
-        self._state: Dict[Tuple[str, str], Tuple[int, int, int, int]] = {}
+        self._names: List[str] = []
+        self._names_t: Tuple[str, ...] = ()
+        self._led_idx: Dict[str, int] = {}
+        self._rgb: List[List[Tuple[int, int, int]]] = [[] for _ in SIDES]
+        self._prio: List[List[int]] = [[] for _ in SIDES]
+        self.version: int = 0
+        self._changed: Set[Tuple[int, int]] = set()
         if led_names:
             for name in led_names:
-                n = name.upper()
                 # Inizializza sia left che right a spento, priorità 0
-                self._state[("left", n)] = (0, 0, 0, 0)
-                self._state[("right", n)] = (0, 0, 0, 0)
+                self._index_of(name.upper())
+
+    def _index_of(self, led: str) -> int:
+        """Indice del LED; i nomi sconosciuti vengono aggiunti in coda (lock già preso)."""
+        i = self._led_idx.get(led)
+        if i is None:
+            i = len(self._names)
+            self._names.append(led)
+            self._names_t = tuple(self._names)
+            self._led_idx[led] = i
+            for si in range(len(SIDES)):
+                self._rgb[si].append((0, 0, 0))
+                self._prio[si].append(0)
+        return i
 
     def set(self, side: Optional[str], led_name: str,
             r: int, g: int, b: int, priority: int) -> bool:
         """
         Aggiorna il colore memorizzato se la priorità è >= di quella esistente.
         Restituisce True se l'update viene accettato (e quindi va inviato via USB),
-        False se viene ignorato (es. un loop che prova a sovrascrivere un override).
+        False se viene ignorato (es. un loop che prova a sovrascrivere un override)
+        oppure se è un colore statico identico a quello già impostato.
         """
         led = led_name.upper()
-        side_norm = side.lower() if isinstance(side, str) and side is not None else None
-
-        def _update_for_side(skey: str) -> bool:
-            key = (skey, led)
-            cur = self._state.get(key, (0, 0, 0, 0))
-            _, _, _, cur_prio = cur
-            if priority < cur_prio:
-                # Priorità più bassa: ignora
+        if not isinstance(side, str):
+            # BOTH: applica a left e right
+            sides: Tuple[int, ...] = (0, 1)
+        else:
+            si = SIDE_IDX.get(side.lower())
+            if si is None:
                 return False
-            new_prio = priority
-            # Convenzione: override (priority>0) con RGB=(0,0,0) rilascia il LED al loop
-            if priority > 0 and r == 0 and g == 0 and b == 0:
-                new_prio = 0
-            self._state[key] = (r, g, b, new_prio)
-            return True
+            sides = (si,)
+
+        new_prio = priority
+        # Convenzione: override (priority>0) con RGB=(0,0,0) rilascia il LED al loop
+        if priority > 0 and r == 0 and g == 0 and b == 0:
+            new_prio = 0
+        rgb = (r, g, b)
+        # Reinvio dello stesso colore statico su un LED già tenuto da uno
+        # STATIC: nessun cambiamento da inviare. Si confronta la priorità
+        # richiesta, non quella dopo il rilascio: "LED1 0 0 0" su un effetto a
+        # base nera (rgb 0,0,0, prio 0) deve passare, altrimenti l'effetto non
+        # verrebbe mai fermato. Un LED tenuto da uno STATIC non ha effetti attivi.
+        static = priority == PRIO_STATIC
 
         updated = False
         with self._lock:
-            if side_norm is None:
-                # BOTH: applica a left e right
-                for skey in ("left", "right"):
-                    if _update_for_side(skey):
-                        updated = True
-            elif side_norm in ("left", "right"):
-                updated = _update_for_side(side_norm)
+            i = self._index_of(led)
+            for si in sides:
+                prio_row = self._prio[si]
+                cur_prio = prio_row[i]
+                if priority < cur_prio:
+                    # Priorità più bassa: ignora
+                    continue
+                if static and cur_prio == priority and self._rgb[si][i] == rgb:
+                    continue
+                self._rgb[si][i] = rgb
+                prio_row[i] = new_prio
+                self._changed.add((si, i))
+                updated = True
+            if updated:
+                self.version += 1
         return updated
 
-    def snapshot(self) -> Dict[Tuple[str, str], Tuple[int, int, int]]:
-        """Ritorna una copia (side, led) -> (r,g,b) senza i livelli di priorità."""
+    def drain_changes(self) -> Tuple[int, Tuple[str, ...], Dict[Tuple[int, int], Tuple[int, int, int]]]:
+        """
+        Ritorna (version, nomi, {(si, i): (r,g,b)}) per le celle cambiate
+        dall'ultima chiamata e svuota l'insieme dei cambiamenti.
+        """
         with self._lock:
-            return {(side, led): (r, g, b)
-                    for (side, led), (r, g, b, _prio) in self._state.items()}
+            rgb = self._rgb
+            changes = {(si, i): rgb[si][i] for si, i in self._changed}
+            self._changed.clear()
+            return self.version, self._names_t, changes
+
+
+# Tinte RAINBOW precalcolate: 6 sestanti HSV da 256 passi, S=1 e V=255,
+# solo interi (x = posizione nel sestante)
+RAINBOW_STEPS = 6 * 256
+
+def _rainbow_rgb(h6: int) -> Tuple[int, int, int]:
+    sext, x = h6 >> 8, h6 & 0xFF
+    return ((255, x, 0), (255 - x, 255, 0), (0, 255, x),
+            (0, 255 - x, 255), (x, 0, 255), (255, 0, 255 - x))[sext]
+
+RAINBOW_LUT: Tuple[Tuple[int, int, int], ...] = tuple(_rainbow_rgb(h) for h in range(RAINBOW_STEPS))
 
 
 class EffectRegistry:
@@ -339,6 +683,10 @@ class EffectRegistry:
     Gestisce gli effetti dinamici (BLINK/FADE/RAINBOW) per ogni LED per lato.
 
     _effects[(side, led)] = (mode, period_ms, start_time, (r,g,b), priority)
+
+    _effects è copy-on-write: i writer (Handler) costruiscono un nuovo dict
+    sotto _lock e sostituiscono il riferimento; i lettori (stream_worker)
+    leggono self._effects senza lock, il dict ottenuto non cambia più.
     """
 
     def __init__(self):
@@ -363,37 +711,58 @@ class EffectRegistry:
                 return
             sides = [s]
 
+        # stesso istante di partenza per entrambi i lati
+        t0 = time.monotonic()
         with self._lock:
+            effects = self._effects
+            new: Optional[Dict[Tuple[str, str], Tuple[str, int, float, Tuple[int, int, int], int]]] = None
             for s in sides:
                 key = (s, led_up)
                 if mode is None:
-                    self._effects.pop(key, None)
+                    if key in effects:
+                        if new is None:
+                            new = dict(effects)
+                        del new[key]
                     continue
-                cur = self._effects.get(key)
+                cur = effects.get(key)
                 cur_prio = cur[4] if cur is not None else 0
                 if priority < cur_prio:
                     # Non sovrascrivere un effetto di priorità maggiore
                     continue
-                self._effects[key] = (
+                if new is None:
+                    new = dict(effects)
+                new[key] = (
                     mode,
                     max(1, period_ms),
-                    time.monotonic(),
+                    t0,
                     base_rgb,
                     priority,
                 )
+            if new is not None:
+                # pubblicazione atomica del nuovo dict
+                self._effects = new
+
+    def has_effects(self) -> bool:
+        """True se almeno un effetto è attivo (lettura senza lock)."""
+        return bool(self._effects)
 
-    def apply(self, side: str, led_name: str,
-              base_rgb: Tuple[int, int, int]) -> Tuple[int, int, int]:
+    def colors(self, now: Optional[float] = None) -> Dict[Tuple[str, str], Tuple[int, int, int]]:
         """
-        Ritorna il colore da inviare tenendo conto dell'effetto (se presente).
+        Colori correnti di tutti i LED con un effetto attivo, (side, led) ->
+        (r,g,b), tutti allo stesso istante `now` (default time.monotonic()).
         """
-        led_up = led_name.upper()
-        key = (side, led_up)
-        with self._lock:
-            eff = self._effects.get(key)
-        if not eff:
-            return base_rgb
+        effects = self._effects
+        if not effects:
+            return {}
+        if now is None:
+            now = time.monotonic()
+        effect_rgb = self._effect_rgb
+        return {key: effect_rgb(eff, now) for key, eff in effects.items()}
 
+    @staticmethod
+    def _effect_rgb(eff: Tuple[str, int, float, Tuple[int, int, int], int],
+                    now: float) -> Tuple[int, int, int]:
+        """Colore dell'effetto `eff` all'istante `now`."""
         mode, period_ms, t0, eff_rgb, _prio = eff
         r0, g0, b0 = eff_rgb
 
@@ -402,7 +771,7 @@ class EffectRegistry:
                 return eff_rgb
             # half_period: tempo acceso/spento. Esempio: 500ms => 500 ON, 500 OFF.
             half_period = period_ms / 1000.0
-            phase = int((time.monotonic() - t0) / half_period)
+            phase = int((now - t0) / half_period)
             on = (phase % 2) == 0
             return eff_rgb if on else (0, 0, 0)
 
@@ -410,7 +779,7 @@ class EffectRegistry:
             if period_ms <= 0:
                 return eff_rgb
             period_s = period_ms / 1000.0
-            pos = (time.monotonic() - t0) % period_s
+            pos = (now - t0) % period_s
             frac = pos / period_s
             # onda triangolare 0..1..0
             if frac < 0.5:
@@ -420,34 +789,56 @@ class EffectRegistry:
             return (int(r0 * k), int(g0 * k), int(b0 * k))
 
         if mode == "RAINBOW":
-            # Ciclo di hue HSV 0..1 con periodo "period_ms".
-            # Luminosità presa dal max componente del colore base (se tutto 0, usiamo 1.0).
+            # Ciclo di hue HSV con periodo "period_ms", da RAINBOW_LUT (S=1, V=255).
+            # Luminosità presa dal max componente del colore base (se tutto 0, piena).
             if period_ms <= 0:
                 period_ms = 1000
-            period_s = period_ms / 1000.0
-            pos = (time.monotonic() - t0) % period_s
-            h = pos / period_s  # 0..1
-            base_val = max(r0, g0, b0) / 255.0
-            if base_val <= 0.0:
-                base_val = 1.0
-            r_f, g_f, b_f = colorsys.hsv_to_rgb(h, 1.0, base_val)
-            return (int(r_f * 255), int(g_f * 255), int(b_f * 255))
+            pos_ms = int((now - t0) * 1000.0) % period_ms
+            rgb = RAINBOW_LUT[pos_ms * RAINBOW_STEPS // period_ms]
+            v = max(r0, g0, b0)
+            if v <= 0 or v >= 255:
+                return rgb
+            r, g, b = rgb
+            return (r * v // 255, g * v // 255, b * v // 255)
 
         # fallback: nessun effetto speciale
         return eff_rgb
 
 
 
+def _stream_wait(server: "ThreadedTCPServer", timeout: Optional[float]) -> None:
+    """
+    Attende il prossimo tick (timeout in s, None = nessun tick) oppure una
+    notifica di cambio stato dal Handler (server.notify_stream()).
+    """
+    cv: Optional[threading.Condition] = getattr(server, "stream_cv", None)
+    if cv is None:
+        time.sleep(timeout if timeout is not None else 0.1)
+        return
+    with cv:
+        if not server.stream_dirty and not server.stream_stop:
+            cv.wait(timeout)
+        server.stream_dirty = False
+
+
 def stream_worker(server: "ThreadedTCPServer"):
     """
     Thread opzionale che invia periodicamente solo i LED che cambiano.
     - Usa server.led_state come sorgente dei colori "base".
     - Applica eventuali effetti BLINK/FADE/RAINBOW dall'EffectRegistry.
     - Non invia nulla se non ci sono differenze rispetto al frame precedente.
+    - Con effetti attivi i tick seguono una cadenza fissa (scadenze
+      monotone t0 + n*interval, senza deriva); senza effetti il thread
+      dorme sulla condition server.stream_cv finché un comando non cambia
+      lo stato, senza risvegli periodici.
     - Se non arrivano comandi dal client per stream_idle_timeout_ms e
       NON ci sono effetti attivi, lo stream va in idle.
       Se invece ci sono effetti attivi, continua all'infinito (finché non
       vengono cancellati con un comando STATIC).
+    - Resta un thread e non un processo separato: l'interfaccia USB è
+      reclamata da un solo processo, le write avvengono già nei thread
+      writer dei device (fuori dal GIL durante la chiamata a libusb) e il
+      calcolo per tick è limitato ai LED con effetto attivo.
     """
     interval_ms = getattr(server, "stream_interval_ms", 0)
     if interval_ms <= 0:
@@ -455,9 +846,22 @@ def stream_worker(server: "ThreadedTCPServer"):
 
     max_entries = getattr(server, "max_entries", 15)
     debug = getattr(server, "debug", False)
-
-    # stato del frame precedente dopo l'applicazione degli effetti
-    prev_frame: Dict[Tuple[Optional[str], str], Tuple[int, int, int]] = {}
+    interval_s = interval_ms / 1000.0
+
+    led_state: LEDState = server.led_state
+    # Copia locale dei colori "base" (aggiornata solo con le celle cambiate)
+    # e dell'ultimo colore inviato per cella (None = mai inviato)
+    names: Tuple[str, ...] = ()
+    led_idx: Dict[str, int] = {}
+    base_rows: List[List[Tuple[int, int, int]]] = [[] for _ in SIDES]
+    sent_rows: List[List[Optional[Tuple[int, int, int]]]] = [[] for _ in SIDES]
+    seen_version = -1
+    # True => reinvia tutte le celle (primo frame, uscita da idle)
+    full = True
+    next_tick = time.monotonic()
+    addr_idx_get = ADDR_IDX.get
+    pack_argb = _S_BBBB
+    idle = False
 
     try:
         while not getattr(server, "stream_stop", False):
@@ -470,78 +874,98 @@ def stream_worker(server: "ThreadedTCPServer"):
             # - e NON ci sono effetti attivi -> vai in idle
             # - se invece ci sono effetti attivi, continui a streammare
             effects_reg: Optional[EffectRegistry] = getattr(server, "effects", None)
-            any_effects = False
-            if effects_reg is not None:
-                try:
-                    with effects_reg._lock:
-                        any_effects = bool(effects_reg._effects)
-                except Exception:
-                    any_effects = False
+            any_effects = effects_reg is not None and effects_reg.has_effects()
 
             if idle_ms > 0 and last_rx is not None and not any_effects:
                 if (now - last_rx) * 1000.0 > idle_ms:
-                    if debug:
-                        print(f"[STRM] idle da {int((now - last_rx)*1000)} ms -> nessun invio (no effects)")
-                    prev_frame.clear()
-                    time.sleep(interval_ms / 1000.0)
+                    if not idle:
+                        if debug:
+                            print(f"[STRM] idle da {int((now - last_rx)*1000)} ms -> nessun invio (no effects)")
+                        sent_rows = [[None] * len(names) for _ in SIDES]
+                        full = True
+                        idle = True
+                    # nessun tick finché non arriva un nuovo comando
+                    _stream_wait(server, None)
                     continue
-
-            snap = server.led_state.snapshot()
+            idle = False
+
+            # Solo le celle cambiate dall'ultimo tick (niente snapshot completo)
+            dirty: Set[Tuple[int, int]] = set()
+            if led_state.version != seen_version:
+                seen_version, cur_names, changes = led_state.drain_changes()
+                if len(cur_names) != len(names):
+                    names = cur_names
+                    led_idx = {n: i for i, n in enumerate(names)}
+                    for si in range(len(SIDES)):
+                        grow = len(names) - len(base_rows[si])
+                        base_rows[si].extend([(0, 0, 0)] * grow)
+                        sent_rows[si].extend([None] * grow)
+                for (si, i), rgb in changes.items():
+                    base_rows[si][i] = rgb
+                dirty.update(changes)
+            if full:
+                dirty.update((si, i) for si in range(len(SIDES)) for i in range(len(names)))
+                full = False
+
+            # Più i LED con un effetto attivo, colori calcolati in una passata
+            fx: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
             effects: Optional[EffectRegistry] = getattr(server, "effects", None)
+            if effects is not None:
+                # stesso istante del controllo di inattività
+                for (side, led), rgb in effects.colors(now).items():
+                    si = SIDE_IDX.get(side)
+                    i = led_idx.get(led)
+                    if si is not None and i is not None:
+                        fx[(si, i)] = rgb
+                dirty.update(fx)
 
-            entries_both: List[Tuple[bytes, bytes]] = []
             entries_left: List[Tuple[bytes, bytes]] = []
             entries_right: List[Tuple[bytes, bytes]] = []
 
-            # nuovo frame dopo applicazione effetti
-            cur_frame: Dict[Tuple[Optional[str], str], Tuple[int, int, int]] = {}
-
-            for (side, led), (r, g, b) in snap.items():
-                base_rgb = (r, g, b)
-
-                # Applica eventuale effetto
-                if effects is not None and side in ("left", "right"):
-                    r, g, b = effects.apply(side, led, base_rgb)
-
-                rgb = (r, g, b)
-                key = (side, led)
-                cur_frame[key] = rgb
-
-                # Se il colore (dopo effetto) è identico al frame precedente,
+            for cell in sorted(dirty):
+                si, i = cell
+                rgb = fx.get(cell) or base_rows[si][i]
+                # Se il colore (dopo effetto) è identico all'ultimo inviato,
                 # non c'è bisogno di inviare nulla per questo LED.
-                prev_rgb = prev_frame.get(key)
-                if prev_rgb is not None and prev_rgb == rgb:
+                if sent_rows[si][i] == rgb:
                     continue
+                sent_rows[si][i] = rgb
 
                 # Da qui in poi il LED è effettivamente cambiato: includiamo
                 # l'aggiornamento nel pacchetto, anche se è (0,0,0) per lo spegnimento.
-                for lname in expand_leds(led):
-                    try:
-                        idx, argb = build_entry(lname, r, g, b)
-                    except KeyError:
+                entries = entries_left if si == 0 else entries_right
+                r, g, b = rgb
+                for lname in expand_leds(names[i]):
+                    ai = addr_idx_get(lname)
+                    if ai is None:
                         continue
-                    if side == "left":
-                        entries_left.append((idx, argb))
-                    elif side == "right":
-                        entries_right.append((idx, argb))
-                    else:
-                        entries_both.append((idx, argb))
-
-            # Aggiorna il frame precedente
-            prev_frame = cur_frame
+                    entries.append((ai[1], pack_argb(ai[0], r, g, b)))
+
+            # Prossima scadenza: avanza solo quando il tick e' arrivato
+            # (un risveglio anticipato per notifica non sposta la cadenza).
+            if now >= next_tick:
+                next_tick += interval_s
+                if next_tick <= now:
+                    # in ritardo: riallinea senza recuperare tick persi
+                    next_tick = now + interval_s
+            if any_effects:
+                wait_s: Optional[float] = max(0.0, next_tick - time.monotonic())
+            elif idle_ms > 0 and last_rx is not None:
+                # risveglio solo per entrare in idle
+                wait_s = max(0.0, last_rx + idle_ms / 1000.0 - time.monotonic()) + interval_s
+            else:
+                wait_s = None
 
             # Se niente è cambiato, aspettiamo solo il prossimo tick.
-            if not entries_both and not entries_left and not entries_right:
-                time.sleep(interval_ms / 1000.0)
+            if not entries_left and not entries_right:
+                _stream_wait(server, wait_s)
                 continue
 
-            packets_both  = pack_by_index(entries_both,  max_entries=max_entries)
             packets_left  = pack_by_index(entries_left,  max_entries=max_entries)
             packets_right = pack_by_index(entries_right, max_entries=max_entries)
 
             if debug:
-                for dev_name, plist in (("BOTH", packets_both),
-                                        ("LEFT", packets_left),
+                for dev_name, plist in (("LEFT", packets_left),
                                         ("RIGHT", packets_right)):
                     for p in plist:
                         idx_hex = p[:4].hex(" ").upper()
@@ -549,168 +973,512 @@ def stream_worker(server: "ThreadedTCPServer"):
                         print(f"[STRM] PACK {dev_name}: len={len(p)} index=[{idx_hex}] entries={n}  HEX={p.hex(' ').upper()}")
 
             # Invio vero e proprio
-            if packets_both:
-                server.devices.send_packets(packets_both, None)
             if packets_left:
                 server.devices.send_packets(packets_left, "left")
             if packets_right:
                 server.devices.send_packets(packets_right, "right")
 
-            time.sleep(interval_ms / 1000.0)
+            _stream_wait(server, wait_s)
     except Exception:
         traceback.print_exc()
 
 # --------------------- Dispositivi ---------------------
 class Devices:
-    def __init__(self, interface: int, ep_out: int, timeout_ms: int, tx_delay_ms: int, repeat: int, dry_run: bool, debug: bool):
-        self.right = USBDevice(VID, PID_RIGHT, "RIGHT", interface, ep_out, timeout_ms, dry_run, debug)
-        self.left  = USBDevice(VID, PID_LEFT,  "LEFT",  interface, ep_out, timeout_ms, dry_run, debug)
+    def __init__(self, interface: int, ep_out: int, timeout_ms: int, tx_delay_ms: int, repeat: int, dry_run: bool, debug: bool,
+                 bulk_chunk_size: int = BULK_CHUNK_SIZE_DEFAULT,
+                 coalesce_ms: float = COALESCE_MS_DEFAULT, max_entries: int = 15):
+        self.right = USBDevice(VID, PID_RIGHT, "RIGHT", interface, ep_out, timeout_ms, dry_run, debug, max_entries)
+        self.left  = USBDevice(VID, PID_LEFT,  "LEFT",  interface, ep_out, timeout_ms, dry_run, debug, max_entries)
         self.debug = debug
         self.tx_delay_ms = tx_delay_ms
         self.repeat = max(1, repeat)
+        self.bulk_chunk_size = bulk_chunk_size
+        self.max_entries = max_entries
+        # Coalescenza tra connessioni: entry in attesa per lato, ultimo valore
+        # vince per (INDEX, ADDR); svuotate dal thread flusher dopo coalesce_ms
+        self.coalesce_ms = max(0.0, coalesce_ms)
+        self._pend_cv = threading.Condition()
+        self._pending: Dict[str, Dict[Tuple[bytes, int], bytes]] = {"left": {}, "right": {}}
+        self._flush_stop = False
+        self._flush_thread: Optional[threading.Thread] = None
 
     def open_all(self):
         self.right.open()
         self.left.open()
+        self.right.start_writer()
+        self.left.start_writer()
+        if self.coalesce_ms > 0:
+            self._flush_stop = False
+            self._flush_thread = threading.Thread(target=self._flush_loop, name="usb-coalesce", daemon=True)
+            self._flush_thread.start()
 
     def close_all(self):
+        t = self._flush_thread
+        if t is not None:
+            with self._pend_cv:
+                self._flush_stop = True
+                self._pend_cv.notify_all()
+            t.join(timeout=1.0)
+            self._flush_thread = None
+        self.flush()
+        self.right.stop_writer()
+        self.left.stop_writer()
         self.right.close()
         self.left.close()
 
+    def coalescing(self) -> bool:
+        """True se il thread flusher della coalescenza è attivo."""
+        return self._flush_thread is not None
+
+    def enqueue(self, entries: List[Tuple[bytes, bytes]], side: Optional[str]):
+        """
+        Accoda entry (INDEX, ADDR+RGB) per il lato indicato (None = entrambi).
+        Entro coalesce_ms le entry di più connessioni finiscono negli stessi
+        pacchetti; si svuota subito quando un lato riempie un pacchetto.
+        Con coalescenza disattivata impacchetta e invia subito.
+        """
+        if not entries:
+            return
+        if self._flush_thread is None:
+            self.send_packets(pack_by_index(entries, max_entries=self.max_entries), side)
+            return
+        sides = ("left", "right") if side is None else (side,)
+        full = False
+        with self._pend_cv:
+            for sd in sides:
+                pend = self._pending[sd]
+                for idx, argb in entries:
+                    pend[(idx, argb[0])] = argb
+                if len(pend) >= self.max_entries:
+                    full = True
+            if not full:
+                self._pend_cv.notify()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Impacchetta e invia tutte le entry in attesa."""
+        with self._pend_cv:
+            pending = self._pending
+            if not pending["left"] and not pending["right"]:
+                return
+            self._pending = {"left": {}, "right": {}}
+        for sd in ("left", "right"):
+            pend = pending[sd]
+            if not pend:
+                continue
+            packets = pack_by_index([(idx, argb) for (idx, _addr), argb in pend.items()],
+                                    max_entries=self.max_entries)
+            if self.debug:
+                for p in packets:
+                    idx_hex = p[:4].hex(" ").upper()
+                    n = (len(p) - 4) // 4
+                    print(f"[DBG] PACK {sd.upper()}: len={len(p)} index=[{idx_hex}] entries={n}  HEX={p.hex(' ').upper()}")
+            self.send_packets(packets, sd)
+
+    def _flush_loop(self):
+        cv = self._pend_cv
+        window_s = self.coalesce_ms / 1000.0
+        while True:
+            with cv:
+                while not self._flush_stop and not self._pending["left"] and not self._pending["right"]:
+                    cv.wait()
+                if self._flush_stop:
+                    return
+            # finestra di raccolta: le connessioni successive si accodano qui
+            time.sleep(window_s)
+            self.flush()
+
+    def send_one(self, side: Optional[str], led_name: str, r: int, g: int, b: int):
+        """
+        Percorso veloce per un solo LED: copia il template da 8 byte e scrive
+        solo R,G,B, senza pack_by_index. Ogni chiamata ha il suo buffer,
+        quindi può restare in coda al writer senza copie ulteriori.
+        """
+        buf = bytearray(LED_TEMPLATE[led_name])
+        buf[5] = r; buf[6] = g; buf[7] = b
+        packets = [buf]
+        if side in (None, "right"):
+            self.right.enqueue(packets, self.repeat, self.tx_delay_ms)
+        if side in (None, "left"):
+            self.left.enqueue(packets, self.repeat, self.tx_delay_ms)
+
     def send_packets(self, packets: List[bytes], side: Optional[str]):
         targets = []
         if side in (None, "right"):
             targets.append(self.right)
         if side in (None, "left"):
             targets.append(self.left)
+        # Con tx_delay la pausa tra pacchetti e' voluta: niente coalescenza
+        if self.tx_delay_ms <= 0:
+            packets = coalesce_packets(packets, self.bulk_chunk_size)
+        # Le write USB avvengono nel thread writer di ogni device:
+        # Handler e stream_worker non aspettano il bus
         for dev in targets:
-            for p in packets:
-                for _ in range(self.repeat):
-                    dev.write(p)
-                if self.tx_delay_ms > 0:
-                    time.sleep(self.tx_delay_ms/1000.0)
+            dev.enqueue(packets, self.repeat, self.tx_delay_ms)
+
+# Righe comando già analizzate: (side, led, r, g, b, effetto|None, periodo_ms)
+Row = Tuple[Optional[str], str, int, int, int, Optional[str], int]
+
+
+def apply_commands(server: "ThreadedTCPServer", rows: List[Row], errors: List[str]) -> None:
+    """
+    Applica al server (stato, effetti, invio USB) un gruppo di righe.
+    Gli errori per riga vengono aggiunti a `errors`.
+    """
+    debug = getattr(server, "debug", False)
+    effects: Optional[EffectRegistry] = getattr(server, "effects", None)
+
+    # Backend USB nativo
+    entries_both: List[Tuple[bytes, bytes]] = []
+    entries_left: List[Tuple[bytes, bytes]] = []
+    entries_right: List[Tuple[bytes, bytes]] = []
+
+    led_state: Optional[LEDState] = getattr(server, "led_state", None)
+    # (side, led, r, g, b) da inviare subito, impacchettati a fine batch
+    immediate: List[Tuple[Optional[str], str, int, int, int]] = []
+
+    for side, led_name, r, g, b, mode, period_ms in rows:
+        try:
+            # PRIORITY:
+            # - BLINK / FADE / RAINBOW => PRIO_EFFECT
+            # - STATIC                 => PRIO_STATIC (può sovrascrivere gli effetti)
+            if mode is not None:
+                priority = PRIO_EFFECT
+            else:
+                priority = PRIO_STATIC
+
+            for lname in expand_leds(led_name):
+                accept = True
+                if led_state is not None:
+                    accept = led_state.set(side, lname, r, g, b, priority)
+                if not accept:
+                    # Es. comando di priorità più bassa rispetto allo stato corrente
+                    continue
+
+                # Gestione effetti: BLINK/FADE/RAINBOW oppure clear se mode è None
+                if effects is not None:
+                    effects.set_effect(side, lname, mode, period_ms, (r, g, b), priority)
+                    if debug:
+                        side_label = "BOTH" if side is None else side.upper()
+                        if mode is None:
+                            print(f"[FX] CLEAR {side_label}:{lname}")
+                        else:
+                            print(f"[FX] SET {mode} {side_label}:{lname} period={period_ms}ms rgb=({r},{g},{b}) prio={priority}")
+
+                # Decide se inviare SUBITO il frame o lasciare tutto allo streaming
+                send_immediate = True
+                if mode in ("BLINK", "FADE", "RAINBOW") and getattr(server, "stream_interval_ms", 0) > 0:
+                    # Se c'è uno stream attivo, per BLINK/FADE/RAINBOW non mandiamo il frame statico
+                    # così l'effetto parte da spento e viene gestito dal thread di streaming.
+                    send_immediate = False
+
+                if send_immediate:
+                    if lname not in LED_TEMPLATE:
+                        LED_MAP.get(lname)  # KeyError "LED non definito"
+                    immediate.append((side, lname, r, g, b))
+
+        except Exception as e:
+            errors.append(str(e))
+
+    # Sveglia il thread di streaming (se presente) sul nuovo stato
+    notify = getattr(server, "notify_stream", None)
+    if notify is not None:
+        notify()
+
+    devices = getattr(server, "devices", None)
+    coalescing = devices is not None and devices.coalescing()
+    if len(immediate) == 1 and not debug and devices is not None and not coalescing:
+        # Caso comune: un solo LED -> template precompilato
+        devices.send_one(*immediate[0])
+        immediate = []
+
+    for side, lname, r, g, b in immediate:
+        idx, argb = build_entry(lname, r, g, b)
+        if side is None:
+            entries_both.append((idx, argb))
+        elif side == "left":
+            entries_left.append((idx, argb))
+        elif side == "right":
+            entries_right.append((idx, argb))
+
+    if coalescing:
+        # Impacchettate dal flusher insieme a quelle di altre connessioni
+        devices.enqueue(entries_both, None)
+        devices.enqueue(entries_left, "left")
+        devices.enqueue(entries_right, "right")
+        entries_both, entries_left, entries_right = [], [], []
+
+    max_entries = getattr(server, "max_entries", 15)
+    packets_both  = pack_by_index(entries_both,  max_entries=max_entries)
+    packets_left  = pack_by_index(entries_left,  max_entries=max_entries)
+    packets_right = pack_by_index(entries_right, max_entries=max_entries)
+
+    if debug:
+        for dev_name, plist in (("BOTH", packets_both),
+                                ("LEFT", packets_left),
+                                ("RIGHT", packets_right)):
+            for p in plist:
+                idx_hex = p[:4].hex(" ").upper()
+                n = (len(p) - 4) // 4
+                print(f"[DBG] PACK {dev_name}: len={len(p)} index=[{idx_hex}] entries={n}  HEX={p.hex(' ').upper()}")
+
+    # Invio immediato (anche se c'è lo streaming, non dà fastidio)
+    if devices is not None:
+        if packets_both:
+            devices.send_packets(packets_both, None)
+        if packets_left:
+            devices.send_packets(packets_left, "left")
+        if packets_right:
+            devices.send_packets(packets_right, "right")
+
+
+Cell = Tuple[str, str]
+# Riga ritardata + generazione di ogni sua cella al momento della ricezione
+Stamped = Tuple[Row, Tuple[Tuple[Cell, int], ...]]
+
+
+def row_cells(row: Row) -> Tuple[Cell, ...]:
+    """Celle fisiche (side, LED) toccate da una riga (BOTH e gruppi espansi)."""
+    side = row[0]
+    sides = ("left", "right") if side is None else (side,)
+    return tuple((s, led) for s in sides for led in expand_leds(row[1]))
+
+
+def bump_generations(server: "ThreadedTCPServer", row: Row) -> Tuple[Tuple[Cell, int], ...]:
+    """
+    Incrementa la generazione delle celle di `row` (con server.apply_lock preso)
+    e ritorna le nuove generazioni: una riga ritardata vale solo se nessun
+    comando più recente ha toccato le sue celle nel frattempo.
+    """
+    gens = server.led_gen
+    stamp = []
+    for cell in row_cells(row):
+        g = gens.get(cell, 0) + 1
+        gens[cell] = g
+        stamp.append((cell, g))
+    return tuple(stamp)
+
+
+def schedule_commands(server: "ThreadedTCPServer", after_ms: int, stamped: List[Stamped]) -> None:
+    """
+    Applica le righe tra after_ms millisecondi (suffisso AFTER, es. modo SEQ).
+    Non crea un thread per batch: accoda nell'heap server.after_heap, servito
+    da un solo thread (after_worker) avviato alla prima richiesta.
+    """
+    due = time.monotonic() + after_ms / 1000.0
+    cv = server.after_cv
+    with cv:
+        heapq.heappush(server.after_heap, (due, next(server.after_seq), after_ms, stamped))
+        if server.after_thread is None:
+            server.after_thread = threading.Thread(target=after_worker, args=(server,),
+                                                   name="after", daemon=True)
+            server.after_thread.start()
+        cv.notify()
+
+
+def apply_delayed(server: "ThreadedTCPServer", after_ms: int, stamped: List[Stamped], debug: bool) -> None:
+    """
+    Applica un gruppo di righe AFTER scadute. Le righe superate da un comando
+    più recente sugli stessi LED (generazione cambiata) vengono scartate:
+    così un "off" dopo una sequenza SEQ non viene riacceso dalle righe
+    ancora in attesa.
+    """
+    errors: List[str] = []
+    stale = 0
+    with server.apply_lock:
+        gens = server.led_gen
+        rows: List[Row] = []
+        for row, stamp in stamped:
+            live = [cell for cell, g in stamp if gens.get(cell) == g]
+            if len(live) == len(stamp):
+                rows.append(row)
+                continue
+            # superata solo in parte (es. LED9 dopo un "LED9A 0 0 0"):
+            # applica la riga alle sole celle ancora valide
+            stale += len(stamp) - len(live)
+            rows.extend((side, led) + row[2:] for side, led in live)
+        if rows:
+            apply_commands(server, rows, errors)
+    if debug:
+        if stale:
+            print(f"[AFTER] {after_ms}ms: {stale} LED superati da comandi più recenti")
+        if errors:
+            print(f"[AFTER] {after_ms}ms: righe scartate {errors}")
+
+
+def after_worker(server: "ThreadedTCPServer") -> None:
+    """
+    Thread unico delle righe AFTER: dorme sulla Condition fino alla prima
+    scadenza dell'heap, poi applica in ordine tutti i gruppi scaduti.
+    """
+    debug = getattr(server, "debug", False)
+    cv = server.after_cv
+    heap = server.after_heap
+    while True:
+        with cv:
+            while True:
+                if not heap:
+                    cv.wait()
+                    continue
+                wait = heap[0][0] - time.monotonic()
+                if wait <= 0:
+                    break
+                cv.wait(wait)
+            now = time.monotonic()
+            ready = []
+            while heap and heap[0][0] <= now:
+                ready.append(heapq.heappop(heap))
+        for _due, _seq, after_ms, stamped in ready:
+            try:
+                apply_delayed(server, after_ms, stamped, debug)
+            except Exception:
+                traceback.print_exc()
+
 
 # --------------------- Server TCP ---------------------
-class Handler(socketserver.StreamRequestHandler):
+class Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        # Risposte JSON piccolissime: niente Nagle, partono subito
+        try:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
     def handle(self):
+        """
+        Legge dal socket con recv() a blocchi (niente readline riga per riga):
+        ogni volta che il buffer termina con righe complete le elabora come un
+        batch e risponde. Una riga vuota o la chiusura chiudono la sessione.
+        """
+        buf = b""
+        handled = False
         try:
-            # Leggi tutte le righe del comando fino a riga vuota / chiusura
-            lines: List[str] = []
             while True:
-                ln = self.rfile.readline()
-                if not ln:
-                    break
-                s = ln.decode("utf-8", "ignore")
-                if s.strip() == "":
+                chunk = self.request.recv(RECV_BUFSIZE)
+                if chunk:
+                    buf += chunk
+                    if not buf.endswith(b"\n"):
+                        # riga incompleta: aspetta il resto
+                        continue
+                pieces = buf.decode("utf-8", "ignore").split("\n")
+                buf = b""
+                if pieces[-1] == "":
+                    pieces.pop()
+                stop = not chunk
+                lines: List[str] = []
+                for s in pieces:
+                    if s.strip() == "":
+                        stop = True
+                        break
+                    lines.append(s)
+                if lines:
+                    self.handle_lines(lines)
+                    handled = True
+                if stop:
                     break
-                lines.append(s)
-            if not lines:
-                self.wfile.write(b'{"ok": false, "error": "no commands"}\n')
-                return
-
-            # Aggiorna il timestamp di ultima RX per il controllo dello streaming
+            if not handled:
+                self.request.sendall(NO_COMMANDS)
+        except Exception as e:
+            traceback.print_exc()
+            err = json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False) + "\n"
             try:
-                self.server.last_rx_ts = time.monotonic()
-            except Exception:
+                self.request.sendall(err.encode("utf-8"))
+            except OSError:
                 pass
 
-            debug = getattr(self.server, "debug", False)
-            if debug:
-                for i, l in enumerate(lines, 1):
-                    print(f"[RX] {i}: {l.rstrip()}")
-
-            errors: List[str] = []
-            effects: Optional[EffectRegistry] = getattr(self.server, "effects", None)
+    def handle_lines(self, lines: List[str]):
+        """Applica un batch di righe comando e invia la risposta JSON."""
+        try:
+            errors = process_lines(self.server, lines)
+            if not errors:
+                self.request.sendall(OK_RESPONSE)
+                return
+            resp = {"ok": True, "skipped": errors}
+            self.request.sendall((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
+        except Exception as e:
+            traceback.print_exc()
+            err = json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False) + "\n"
+            self.request.sendall(err.encode("utf-8"))
 
-            # Backend USB nativo
-            entries_both: List[Tuple[bytes, bytes]] = []
-            entries_left: List[Tuple[bytes, bytes]] = []
-            entries_right: List[Tuple[bytes, bytes]] = []
 
-            led_state: Optional[LEDState] = getattr(self.server, "led_state", None)
+def process_lines(server: "ThreadedTCPServer", lines: List[str]) -> List[str]:
+    """
+    Applica un batch di righe comando (comune a TCP e UDP).
+    Ritorna l'elenco delle righe scartate con il motivo.
+    """
+    # Aggiorna il timestamp di ultima RX per il controllo dello streaming
+    try:
+        server.last_rx_ts = time.monotonic()
+    except Exception:
+        pass
 
-            for s in lines:
-                try:
-                    core_line, mode, period_ms = strip_effect_suffix(s)
-                    side, led_name, r, g, b = parse_command_line(core_line)
-
-                    # PRIORITY:
-                    # - BLINK / FADE / RAINBOW => priority = 1
-                    # - STATIC                 => priority = 2 (può sovrascrivere gli effetti)
-                    if mode in ("BLINK", "FADE", "RAINBOW"):
-                        priority = 1
-                    else:
-                        priority = 2
-
-                    for lname in expand_leds(led_name):
-                        accept = True
-                        if led_state is not None:
-                            accept = led_state.set(side, lname, r, g, b, priority)
-                        if not accept:
-                            # Es. comando di priorità più bassa rispetto allo stato corrente
-                            continue
-
-                        # Gestione effetti: BLINK/FADE/RAINBOW oppure clear se mode è None
-                        if effects is not None:
-                            effects.set_effect(side, lname, mode, period_ms, (r, g, b), priority)
-                            if debug:
-                                side_label = "BOTH" if side is None else side.upper()
-                                if mode is None:
-                                    print(f"[FX] CLEAR {side_label}:{lname}")
-                                else:
-                                    print(f"[FX] SET {mode} {side_label}:{lname} period={period_ms}ms rgb=({r},{g},{b}) prio={priority}")
-
-                        # Decide se inviare SUBITO il frame o lasciare tutto allo streaming
-                        send_immediate = True
-                        if mode in ("BLINK", "FADE", "RAINBOW") and getattr(self.server, "stream_interval_ms", 0) > 0:
-                            # Se c'è uno stream attivo, per BLINK/FADE/RAINBOW non mandiamo il frame statico
-                            # così l'effetto parte da spento e viene gestito dal thread di streaming.
-                            send_immediate = False
-
-                        if send_immediate:
-                            idx, argb = build_entry(lname, r, g, b)
-                            if side is None:
-                                entries_both.append((idx, argb))
-                            elif side == "left":
-                                entries_left.append((idx, argb))
-                            elif side == "right":
-                                entries_right.append((idx, argb))
-
-                except Exception as e:
-                    errors.append(str(e))
-
-            max_entries = getattr(self.server, "max_entries", 15)
-            packets_both  = pack_by_index(entries_both,  max_entries=max_entries)
-            packets_left  = pack_by_index(entries_left,  max_entries=max_entries)
-            packets_right = pack_by_index(entries_right, max_entries=max_entries)
+    if getattr(server, "debug", False):
+        for i, l in enumerate(lines, 1):
+            print(f"[RX] {i}: {l.rstrip()}")
 
-            if debug:
-                for dev_name, plist in (("BOTH", packets_both),
-                                        ("LEFT", packets_left),
-                                        ("RIGHT", packets_right)):
-                    for p in plist:
-                        idx_hex = p[:4].hex(" ").upper()
-                        n = (len(p) - 4) // 4
-                        print(f"[DBG] PACK {dev_name}: len={len(p)} index=[{idx_hex}] entries={n}  HEX={p.hex(' ').upper()}")
-
-            # Invio immediato (anche se c'è lo streaming, non dà fastidio)
-            devices = getattr(self.server, "devices", None)
-            if devices is not None:
-                if packets_both:
-                    devices.send_packets(packets_both, None)
-                if packets_left:
-                    devices.send_packets(packets_left, "left")
-                if packets_right:
-                    devices.send_packets(packets_right, "right")
-
-            resp = {"ok": True}
-            if errors:
-                resp["skipped"] = errors
-            self.wfile.write((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
+    errors: List[str] = []
+    parsed_rows = []
+    for s in lines:
+        try:
+            parsed_rows.append(parse_line(s))
         except Exception as e:
+            errors.append(str(e))
+
+    # Righe da applicare subito e righe ritardate (AFTER <ms>) per ritardo.
+    # Ogni riga, immediata o ritardata, porta avanti la generazione dei suoi
+    # LED: vince sempre il comando ricevuto per ultimo.
+    rows: List[Row] = []
+    delayed: Dict[int, List[Stamped]] = {}
+    with server.apply_lock:
+        for parsed in parsed_rows:
+            row = parsed[:7]
+            stamp = bump_generations(server, row)
+            after_ms = parsed[7]
+            if after_ms > 0:
+                delayed.setdefault(after_ms, []).append((row, stamp))
+            else:
+                rows.append(row)
+        apply_commands(server, rows, errors)
+    for after_ms, group in delayed.items():
+        schedule_commands(server, after_ms, group)
+    return errors
+
+
+# --------------------- Server UDP (opzionale) ---------------------
+class UDPHandler(socketserver.BaseRequestHandler):
+    """
+    Un datagramma = un batch di righe, stesso formato del TCP.
+    Niente risposta: il client locale invia e non aspetta nulla.
+    """
+
+    def handle(self):
+        data = self.request[0]
+        lines = [l for l in data.decode("utf-8", "ignore").split("\n") if l.strip()]
+        if not lines:
+            return
+        target = self.server.target
+        try:
+            errors = process_lines(target, lines)
+        except Exception:
             traceback.print_exc()
-            err = json.dumps({"ok": False, "error": str(e)}, ensure_ascii=False) + "\n"
-            self.wfile.write(err.encode("utf-8"))
+            return
+        if errors and getattr(target, "debug", False):
+            print(f"[UDP] righe scartate: {errors}")
+
+
+class LedUDPServer(socketserver.UDPServer):
+    """
+    Listener UDP che applica i comandi sullo stesso stato del server TCP
+    (`target`). Gestisce un datagramma alla volta, nell'ordine di arrivo.
+    """
+    allow_reuse_address = True
+    max_packet_size = UDP_MAX_DATAGRAM
+
+    def __init__(self, server_address, target: "ThreadedTCPServer"):
+        self.target = target
+        super().__init__(server_address, UDPHandler)
+
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
@@ -721,7 +1489,12 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
                  debug: bool,
                  max_entries: int,
                  stream_interval_ms: int = 0,
-                 led_state: Optional[LEDState] = None):
+                 led_state: Optional[LEDState] = None,
+                 rcvbuf: int = SOCK_BUF_DEFAULT,
+                 sndbuf: int = SOCK_BUF_DEFAULT):
+        # letti da server_bind(), chiamato dentro super().__init__
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
         super().__init__(server_address, RequestHandlerClass)
         self.devices = devices
         self.debug = debug
@@ -736,6 +1509,37 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         self.stream_idle_timeout_ms = 3000
         # Registry per effetti BLINK/FADE/RAINBOW
         self.effects = EffectRegistry()
+        # Condition su cui dorme lo stream_worker; stream_dirty segnala
+        # un cambio di stato arrivato mentre il worker non era in attesa
+        self.stream_cv = threading.Condition()
+        self.stream_dirty = False
+        # Generazione per cella (side, LED), vedi bump_generations; apply_lock
+        # serializza l'applicazione dei comandi immediati e delle righe AFTER
+        self.apply_lock = threading.Lock()
+        self.led_gen: Dict[Cell, int] = {}
+        # Righe AFTER in attesa: heap di (scadenza, seq, after_ms, righe)
+        # servito da after_worker; seq mantiene l'ordine a parità di scadenza
+        self.after_cv = threading.Condition()
+        self.after_heap: List[Tuple[float, int, int, List[Stamped]]] = []
+        self.after_seq = itertools.count()
+        self.after_thread: Optional[threading.Thread] = None
+
+    def server_bind(self):
+        # Buffer del socket in ascolto prima del bind: le connessioni accettate
+        # li ereditano
+        for opt, size in ((socket.SO_RCVBUF, self.rcvbuf), (socket.SO_SNDBUF, self.sndbuf)):
+            if size > 0:
+                try:
+                    self.socket.setsockopt(socket.SOL_SOCKET, opt, size)
+                except OSError as e:
+                    print(f"[TCP] setsockopt {opt}={size} fallito: {e}")
+        super().server_bind()
+
+    def notify_stream(self):
+        """Segnala allo stream_worker che stato/effetti sono cambiati."""
+        with self.stream_cv:
+            self.stream_dirty = True
+            self.stream_cv.notify_all()
 
 
 
@@ -750,8 +1554,20 @@ def main():
     ap.add_argument("--tx-delay-ms", type=int, default=0, help="ritardo tra pacchetti per device")
     ap.add_argument("--repeat", type=int, default=1, help="ripeti ogni pacchetto N volte")
     ap.add_argument("--max-entries", type=int, default=15, help="max (ADDR,R,G,B) per pacchetto")
+    ap.add_argument("--bulk-chunk-size", type=int, default=BULK_CHUNK_SIZE_DEFAULT,
+                    help="max byte per write USB che unisce piu' pacchetti da 64B (0 = disattiva)")
     ap.add_argument("--dry-run", action="store_true")
     ap.add_argument("--debug", action="store_true")
+    ap.add_argument("--coalesce-ms", type=float, default=COALESCE_MS_DEFAULT,
+                    help="unisce in pacchetti comuni i comandi arrivati entro N ms (0 = disattiva)")
+    ap.add_argument("--rcvbuf", type=int, default=SOCK_BUF_DEFAULT,
+                    help="SO_RCVBUF del socket TCP in byte (0 = default OS)")
+    ap.add_argument("--sndbuf", type=int, default=SOCK_BUF_DEFAULT,
+                    help="SO_SNDBUF del socket TCP in byte (0 = default OS)")
+    ap.add_argument("--udp-host", default=UDP_HOST_DEFAULT,
+                    help="indirizzo del listener UDP (default 127.0.0.1, solo locale)")
+    ap.add_argument("--udp-port", type=int, default=0,
+                    help="porta UDP per i comandi senza risposta (0 = disattivato)")
     # Streaming opzionale dello stato (0 = disattivato, default)
     ap.add_argument("--stream-interval-ms", type=int, default=0,
                     help="se >0 invia periodicamente lo stato completo dei LED ogni N ms")
@@ -769,7 +1585,10 @@ def main():
                       tx_delay_ms=args.tx_delay_ms,
                       repeat=args.repeat,
                       dry_run=args.dry_run,
-                      debug=args.debug)
+                      debug=args.debug,
+                      bulk_chunk_size=args.bulk_chunk_size,
+                      coalesce_ms=args.coalesce_ms,
+                      max_entries=args.max_entries)
     devices.open_all()
 
     # Inizializza stato LED (anche se non si usa lo streaming, per la priorità)
@@ -781,7 +1600,9 @@ def main():
                             debug=args.debug,
                             max_entries=args.max_entries,
                             stream_interval_ms=args.stream_interval_ms,
-                            led_state=led_state)
+                            led_state=led_state,
+                            rcvbuf=args.rcvbuf,
+                            sndbuf=args.sndbuf)
 
     # Propaga al server il timeout di inattività per lo streaming
     srv.stream_idle_timeout_ms = args.stream_idle_timeout_ms
@@ -792,6 +1613,13 @@ def main():
         stream_thread = threading.Thread(target=stream_worker, args=(srv,), daemon=True)
         stream_thread.start()
 
+    # Avvia eventuale listener UDP, sullo stesso stato del server TCP
+    udp_srv = None
+    if args.udp_port > 0:
+        udp_srv = LedUDPServer((args.udp_host, args.udp_port), srv)
+        threading.Thread(target=udp_srv.serve_forever, daemon=True).start()
+        print(f"[UDP] In ascolto su {args.udp_host}:{args.udp_port}")
+
     # Messaggio di startup
     print(f"[TCP] In ascolto su {args.host}:{args.port}  "
           f"(IF={args.iface}, EP=0x{args.ep:02X}, timeout={args.usb_timeout_ms}ms, "
@@ -805,8 +1633,11 @@ def main():
         print("\n[QUIT] Ctrl+C")
     finally:
         srv.stream_stop = True
+        srv.notify_stream()
         if stream_thread is not None:
             stream_thread.join(timeout=1.0)
+        if udp_srv is not None:
+            udp_srv.shutdown()
         srv.shutdown()
         if devices is not None:
             devices.close_all()
@@ -1,13 +1,17 @@
 # -*- coding: utf-8; -*-
 
 import os
+import functools
 import logging
 import socket
-import re
+import select
+import threading
 import time
+import re
+from collections import deque
 from xml.etree import ElementTree
 
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtWidgets
 
 from gremlin.base_classes import AbstractAction, AbstractFunctor
 from gremlin.common import InputType
@@ -29,17 +33,185 @@ LED_NAMES = [
     "LED10A", "LED10B", "LED10C",
     "LED11",
 ]
+# Lookup O(1): nome -> posizione nella combo, e insieme dei nomi validi
+_LED_INDEX = {name: i for i, name in enumerate(LED_NAMES)}
+_LED_SET = frozenset(LED_NAMES)
+
+# Tipi di input per cui si invia solo alla pressione (non al rilascio)
+_PRESS_ONLY_TYPES = frozenset((InputType.JoystickButton, InputType.Keyboard))
+
+# Tipo di input -> serve il virtual button (assi e hat sì, pulsanti e tastiera no)
+_VB_TABLE = {
+    InputType.JoystickButton: False,
+    InputType.Keyboard: False,
+    InputType.JoystickAxis: True,
+    InputType.JoystickHat: True,
+}
 
 # Effetti supportati lato client (il server li interpreta)
 EFFECT_CHOICES = ["STATIC", "BLINK", "FADE", "RAINBOW"]
 
+# Attesa (ms) dopo l'ultimo scatto di una spinbox prima di segnalare la modifica
+SPIN_DEBOUNCE_MS = 150
+
+# Regex di _expand_leds_expr_cached, compilate una volta sola
+_SPLIT_RE = re.compile(r"[,\s;]+")
+_LED_RE = re.compile(r"LED(\d+)$")
+# (numero, nome) dei LED "LEDn" senza lettera, in ordine di numero: i range li usano
+_LED_NUMBERED = tuple(sorted(
+    (int(n[3:]), n) for n in LED_NAMES if n[3:].isdigit()
+))
+
 
 # ---------------------------------------------------------------------------
 # Parte di comunicazione TCP (come nel plugin che funzionava, estesa con effetto)
 # ---------------------------------------------------------------------------
 
-def _build_line(led_side, led_name, r, g, b, effect=None, delay_ms=None):
-    """Costruisce una singola riga compatibile con server.py.
+# Connessione TCP persistente verso server.py, condivisa da tutte le azioni:
+# riaperta solo in caso di errore o se il server l'ha chiusa.
+_conn_lock = threading.Lock()
+_conn = None
+_conn_addr = None
+
+# Ultimo valore inviato per LED fisico: (host, port) -> {(lato, LED): valore}.
+# Protetto da _conn_lock; azzerato a ogni nuova connessione, perché il
+# server potrebbe essere stato riavviato e aver perso lo stato.
+_last_state = {}
+
+
+def _close_conn():
+    """Chiude la connessione persistente (chiamare con _conn_lock preso)."""
+    global _conn, _conn_addr, _ack_buf
+    if _conn is not None:
+        try:
+            _conn.close()
+        except OSError:
+            pass
+    _conn = None
+    _conn_addr = None
+    _ack_buf = b""
+
+
+@functools.lru_cache(maxsize=16)
+def _is_ipv4_literal(host):
+    """True se host è già un indirizzo IPv4 numerico (non serve risolverlo)."""
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+    except (OSError, TypeError):
+        return False
+    return True
+
+
+def _get_conn(host, port, timeout):
+    """Ritorna il socket persistente, aprendolo se serve (con _conn_lock preso)."""
+    global _conn, _conn_addr
+    if _conn is not None and _conn_addr != (host, port):
+        _close_conn()
+    if _conn is None:
+        if _is_ipv4_literal(host):
+            # indirizzo numerico (il caso normale, 127.0.0.1): niente getaddrinfo
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                s.settimeout(timeout)
+                s.connect((host, port))
+            except OSError:
+                s.close()
+                raise
+        else:
+            s = socket.create_connection((host, port), timeout=timeout)
+        # righe piccole: niente Nagle, partono subito
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _conn = s
+        _conn_addr = (host, port)
+        _last_state.pop(_conn_addr, None)
+    return _conn
+
+
+# Risposta standard del server (server.OK_RESPONSE senza newline)
+_ACK_OK = b'{"ok": true}'
+_ack_buf = b""
+
+
+def _drain_acks(s):
+    """
+    Legge senza bloccare le risposte JSON già arrivate dal server (niente
+    attesa dopo l'invio): le OK vengono scartate, le altre (righe saltate,
+    errori) finiscono nel log.
+    Solleva ConnectionError se il server ha chiuso la connessione.
+    """
+    global _ack_buf
+    while select.select([s], [], [], 0)[0]:
+        data = s.recv(4096)
+        if not data:
+            raise ConnectionError("connessione chiusa dal server")
+        _ack_buf += data
+    if not _ack_buf:
+        return
+    *answers, _ack_buf = _ack_buf.split(b"\n")
+    for answer in answers:
+        if answer and answer != _ACK_OK:
+            log.warning("[LEDs base] risposta server: %s",
+                        answer.decode("utf-8", "replace"))
+
+
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+_IOV_MAX = 1024  # limite di buffer per singola sendmsg su Linux
+
+
+def _sendall_iov(s, iov):
+    """
+    Invia la lista di buffer `iov` così com'è (scatter-gather con sendmsg),
+    senza concatenarla; gestisce le scritture parziali.
+    Dove sendmsg non c'è (Windows) ripiega su join + sendall.
+    """
+    if not _HAS_SENDMSG:
+        s.sendall(b"".join(iov))
+        return
+    iov = list(iov)
+    while iov:
+        sent = s.sendmsg(iov[:_IOV_MAX])
+        # scarta i buffer già scritti per intero, accorcia quello parziale
+        i = 0
+        while i < len(iov) and sent >= len(iov[i]):
+            sent -= len(iov[i])
+            i += 1
+        del iov[:i]
+        if sent:
+            iov[0] = memoryview(iov[0])[sent:]
+
+
+def _send_payload(iov, host, port, timeout):
+    """Invia i buffer `iov` sulla connessione persistente; riprova una volta riconnettendo."""
+    with _conn_lock:
+        for attempt in (0, 1):
+            try:
+                s = _get_conn(host, port, timeout)
+                _drain_acks(s)
+                _sendall_iov(s, iov)
+                return
+            except OSError:
+                _close_conn()
+                if attempt:
+                    raise
+
+
+# Frammenti della riga già codificati per _build_line_bytes
+_PREFIX = {"LEFT": b"left:", "RIGHT": b"right:", "BOTH": b""}
+_LED_BYTES = {n: n.encode("ascii") for n in LED_NAMES}
+_EFFECT_BYTES = {e: e.encode("ascii") for e in ("BLINK", "FADE", "RAINBOW")}
+
+
+def _build_line_static(prefix, led_name, r, g, b):
+    """Riga STATIC già terminata da newline: `prefix` è un valore di _PREFIX."""
+    name = _LED_BYTES.get(led_name)
+    if name is None:
+        name = str(led_name).encode("utf-8")
+    return b"%s%s %d %d %d\n" % (prefix, name, r, g, b)
+
+
+def _build_line_bytes(led_side, led_name, r, g, b, effect=None, delay_ms=None,
+                      after_ms=None):
+    """Costruisce i byte di una riga compatibile con server.py (senza newline finale).
 
     Formato base (static):
         [left:|right:]LEDx R G B
@@ -48,96 +220,291 @@ def _build_line(led_side, led_name, r, g, b, effect=None, delay_ms=None):
         [left:|right:]LEDx R G B BLINK 500
         [left:|right:]LEDx R G B FADE 1000
         [left:|right:]LEDx R G B RAINBOW 1500
+
+    Con after_ms > 0 il server applica la riga dopo after_ms millisecondi:
+        [left:|right:]LEDx R G B [EFFETTO ms] AFTER 200
+
+    r, g, b, delay_ms e after_ms devono essere interi.
+    """
+    prefix = _PREFIX.get((led_side or "").strip().upper(), b"")
+    name = _LED_BYTES.get(led_name)
+    if name is None:
+        name = str(led_name).encode("utf-8")
+    line = b"%s%s %d %d %d" % (prefix, name, r, g, b)
+
+    eff = _EFFECT_BYTES.get((effect or "STATIC").upper())
+    if eff is not None:
+        # anche 0 è accettato, sarà il server a decidere cosa farne
+        line += b" %s %d" % (eff, delay_ms or 0)
+    if after_ms:
+        line += b" AFTER %d" % after_ms
+    return line
+
+
+# Trasporto UDP opzionale (server.py --udp-port): un datagramma per batch di
+# righe, nessuna connessione né risposta. Il socket è creato una volta sola e
+# usato solo dal thread di invio. Il server apre la porta UDP solo con
+# l'opzione "UDP transport" di plugin.py: senza, i datagrammi vanno persi.
+TRANSPORTS = ("tcp", "udp")
+_UDP_DATAGRAM_MAX = 8192   # byte per datagramma; le righe non vengono mai spezzate
+_udp_sock = None
+
+
+def _send_udp(iov, host, port):
+    """Invia le righe `iov` a host:port via UDP, in pochi datagrammi."""
+    global _udp_sock
+    if _udp_sock is None:
+        _udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = (host, port)
+
+    chunk, size = [], 0
+    for line in iov:
+        if chunk and size + len(line) > _UDP_DATAGRAM_MAX:
+            _send_datagram(chunk, addr)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        _send_datagram(chunk, addr)
+
+
+def _send_datagram(chunk, addr):
+    if _HAS_SENDMSG:
+        _udp_sock.sendmsg(chunk, (), 0, addr)
+    else:
+        _udp_sock.sendto(b"".join(chunk), addr)
+
+
+# Coda verso il thread di invio: process_event accoda e ritorna subito,
+# connect/sendall avvengono fuori dal thread degli eventi di Gremlin.
+_SEND_QUEUE_MAX = 64
+_SEND_BATCH_MAX = 100
+# Finestra di accumulo del thread di invio (secondi): gli aggiornamenti che
+# arrivano entro la finestra vengono fusi, per ogni LED vale l'ultimo.
+SEND_WINDOW_S = 0.005
+# deque + Condition invece di queue.Queue: a coda piena serve togliere un
+# elemento qualsiasi (non solo il più vecchio), cosa che Queue non espone
+_send_q = deque()
+_send_cv = threading.Condition()
+
+
+def _enqueue(item):
+    """
+    Accoda un comando. Se la coda è piena (es. assi molto rapidi) scarta il
+    comando più vecchio per gli stessi LED, altrimenti il più vecchio in assoluto.
     """
-    s = (led_side or "").strip().upper()
-    if s == "LEFT":
-        prefix = "left:"
-    elif s == "RIGHT":
-        prefix = "right:"
-    else:  # BOTH o altro -> nessun prefisso
-        prefix = ""
-
-    parts = [
-        f"{prefix}{led_name}",
-        str(int(r)),
-        str(int(g)),
-        str(int(b)),
-    ]
+    with _send_cv:
+        if len(_send_q) >= _SEND_QUEUE_MAX:
+            key = item[:5]  # host, port, timeout, lato, LED
+            for i, old in enumerate(_send_q):
+                if old[:5] == key:
+                    del _send_q[i]
+                    break
+            else:
+                _send_q.popleft()
+            log.debug("[LEDs base] coda piena, scartato un comando vecchio")
+        _send_q.append(item)
+        _send_cv.notify()
+
+
+def _take_batch():
+    """
+    Attende il primo comando, poi raccoglie quelli che arrivano entro
+    SEND_WINDOW_S (fino a _SEND_BATCH_MAX); scaduta la finestra prende
+    comunque quelli già in coda.
+    """
+    with _send_cv:
+        while not _send_q:
+            _send_cv.wait()
+        items = [_send_q.popleft()]
+        deadline = time.monotonic() + SEND_WINDOW_S
+        while len(items) < _SEND_BATCH_MAX:
+            if _send_q:
+                items.append(_send_q.popleft())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _send_cv.wait(remaining)
+        return items
+
 
+# Lati fisici toccati da una riga: senza prefisso valgono entrambi
+_BOTH_SIDES = ("LEFT", "RIGHT")
+_PHYS_SIDES = {"LEFT": ("LEFT",), "RIGHT": ("RIGHT",)}
+
+# Gruppi espansi dal server (GROUP_ALIASES di server.py): la cache di
+# _last_state lavora sui LED fisici, così LED9 e LED9A si sovrappongono
+_LED_GROUPS = {
+    "LED9": ("LED9A", "LED9B", "LED9C", "LED9D", "LED9E", "LED9F", "LED9G", "LED9H"),
+    "LED10": ("LED10A", "LED10B", "LED10C"),
+}
+
+
+def _phys_cells(side, led_name):
+    """Celle fisiche (lato, LED) toccate da una riga."""
+    leds = _LED_GROUPS.get(led_name, (led_name,))
+    return [(phys, led) for phys in _PHYS_SIDES.get(side, _BOTH_SIDES) for led in leds]
+
+
+def _state_value(r, g, b, effect, delay_ms):
+    """Valore confrontabile di un comando, per saltare i reinvii identici."""
     eff = (effect or "STATIC").upper()
-    if eff in ("BLINK", "FADE", "RAINBOW"):
-        parts.append(eff)
-        # anche 0 è accettato, sarà il server a decidere cosa farne
-        if delay_ms is None:
-            delay_ms = 0
-        parts.append(str(int(delay_ms)))
+    if eff not in _EFFECT_BYTES:
+        return (r, g, b, None, None)
+    return (r, g, b, eff, delay_ms or 0)
 
-    return " ".join(parts)
+
+def _sender_loop():
+    """
+    Thread di invio: prende un comando, poi raccoglie quelli che arrivano
+    entro SEND_WINDOW_S (fino a _SEND_BATCH_MAX) e li spedisce in una sola
+    scrittura per server di destinazione.
+
+    Per ogni (lato, LED) sopravvive solo l'ultimo comando: i valori
+    intermedi di un asse mossi nella stessa finestra non partono proprio.
+    """
+    while True:
+        items = _take_batch()
+
+        # (host, port, timeout, lato, LED) -> (valore, riga, force, trasporto,
+        # in cache); l'ultimo vince
+        pending = {}
+        for (host, port, timeout, led_side, led_list, r, g, b,
+             effect, delay_ms, after_list, force, transport) in items:
+            side = (led_side or "").strip().upper()
+            value = _state_value(r, g, b, effect, delay_ms)
+            # solo le righe STATIC immediate finiscono in _last_state: quelle
+            # con AFTER non sono ancora applicate, gli effetti (priorità più
+            # bassa) possono essere rifiutati dal server
+            cacheable = after_list is None and value[3] is None
+            if cacheable:
+                # caso più comune (STATIC, senza AFTER): formato fisso
+                prefix = _PREFIX.get(side, b"")
+                lines = [_build_line_static(prefix, led_name, r, g, b)
+                         for led_name in led_list]
+            else:
+                if after_list is None:
+                    after_list = [None] * len(led_list)
+                lines = [_build_line_bytes(side, led_name, r, g, b,
+                                           effect, delay_ms, after_ms) + b"\n"
+                         for led_name, after_ms in zip(led_list, after_list)]
+            for led_name, line in zip(led_list, lines):
+                key = (host, port, timeout, side, led_name)
+                # pop + reinserimento: la riga va in fondo, così l'ordine
+                # relativo tra lati diversi (es. BOTH poi left:) resta giusto
+                pending.pop(key, None)
+                pending[key] = (value, line, force, transport, cacheable)
+
+        # (host, port, timeout, trasporto) -> [(celle, valore, riga, in cache)],
+        # nell'ordine di arrivo; su TCP le righe STATIC identiche all'ultimo valore
+        # inviato su tutte le celle fisiche vengono saltate (su UDP no: senza
+        # connessione un riavvio del server non si vede)
+        batches = {}
+        with _conn_lock:
+            for (host, port, timeout, side, led_name), \
+                    (value, line, force, transport, cacheable) in pending.items():
+                cells = _phys_cells(side, led_name)
+                if cacheable and not force and transport == "tcp":
+                    last = _last_state.get((host, port))
+                    if last is not None and all(last.get(c) == value for c in cells):
+                        continue
+                batches.setdefault((host, port, timeout, transport), []).append(
+                    (cells, value, line, cacheable))
+
+        for (host, port, timeout, transport), entries in batches.items():
+            iov = [e[2] for e in entries]
+            if transport == "udp":
+                try:
+                    _send_udp(iov, host, port)
+                except Exception as e:
+                    log.error("[LEDs base] UDP send error: %s", e)
+                    continue
+                # stesso server, stato cambiato fuori dalla cache TCP: il
+                # prossimo STATIC TCP su questi LED deve ripartire
+                with _conn_lock:
+                    last = _last_state.get((host, port))
+                    if last:
+                        for cells, _value, _line, _cacheable in entries:
+                            for c in cells:
+                                last.pop(c, None)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("[LEDs base] TX UDP (%d): %s", len(iov),
+                              b" | ".join(l[:-1] for l in iov).decode("utf-8", "replace"))
+                continue
+            try:
+                _send_payload(iov, host, port, timeout)
+            except Exception as e:
+                log.error("[LEDs base] TCP send error: %s", e)
+                continue
+            with _conn_lock:
+                last = _last_state.setdefault((host, port), {})
+                for cells, value, _line, cacheable in entries:
+                    for c in cells:
+                        if cacheable:
+                            last[c] = value
+                        else:
+                            # stato futuro/incerto: il prossimo STATIC riparte
+                            last.pop(c, None)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[LEDs base] TX (%d): %s", len(iov),
+                          b" | ".join(l[:-1] for l in iov).decode("utf-8", "replace"))
+
+
+_sender = threading.Thread(target=_sender_loop, name="leds-sender", daemon=True)
+_sender.start()
 
 
 def _send_led(led_side, led_name, r, g, b,
               effect=None, delay_ms=None,
-              host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=0.2):
-    """Invia il comando LED al server TCP (UN LED per connessione)."""
-    line = _build_line(led_side, led_name, r, g, b, effect, delay_ms)
-    data = (line + "\n").encode("utf-8")
-    try:
-        with socket.create_connection((host, port), timeout=timeout) as s:
-            s.sendall(data)
-            s.settimeout(0.05)
-            try:
-                _ = s.recv(4096)
-            except Exception:
-                pass
-        log.info(f"[LEDs base] TX: {line}")
-    except Exception as e:
-        log.error(f"[LEDs base] TCP send error: {e}")
+              host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=0.2, force=False,
+              transport="tcp"):
+    """Accoda il comando per UN LED verso il server (non blocca).
+
+    Se il LED ha già questo valore non viene reinviato, salvo force=True.
+    transport: "tcp" (default) oppure "udp" (vedi _send_udp).
+    """
+    _enqueue((host, port, timeout, led_side, (led_name,), r, g, b,
+              effect, delay_ms, None, force, transport))
 
 
 def _send_leds_batch(led_side, led_list, r, g, b,
                      effect=None, delay_ms=None,
-                     host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=0.2):
-    """Invia PIÙ LED in un'unica connessione TCP (tutti insieme)."""
+                     host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=0.2,
+                     after_list=None, force=False, transport="tcp"):
+    """Accoda PIÙ LED da inviare in un'unica scrittura (non blocca).
+
+    after_list (opzionale, un valore per LED) indica dopo quanti ms il
+    server deve applicare ogni riga: serve al modo SEQ.
+    I LED che hanno già questo valore non vengono reinviati, salvo force=True.
+    """
     if not led_list:
         return
-
-    lines = [
-        _build_line(led_side, led_name, r, g, b, effect, delay_ms)
-        for led_name in led_list
-    ]
-    payload = ("\n".join(lines) + "\n").encode("utf-8")
-
-    try:
-        with socket.create_connection((host, port), timeout=timeout) as s:
-            s.sendall(payload)
-            s.settimeout(0.05)
-            try:
-                _ = s.recv(4096)
-            except Exception:
-                pass
-        log.info(f"[LEDs base] TX batch ({len(led_list)}): " + " | ".join(lines))
-    except Exception as e:
-        log.error(f"[LEDs base] TCP send error (batch): {e}")
+    _enqueue((host, port, timeout, led_side, tuple(led_list), r, g, b,
+              effect, delay_ms, None if after_list is None else tuple(after_list),
+              force, transport))
 
 
 # ---------------------------------------------------------------------------
 # Parsing espressione LED (LED1,LED2,LED3 e LED1/LED5)
 # ---------------------------------------------------------------------------
 
-def _expand_leds_expr(expr: str, default_led: str):
+@functools.lru_cache(maxsize=256)
+def _expand_leds_expr_cached(expr: str, default_led: str):
     """
     Espande un'espressione tipo:
       - "LED1,LED2,LED3"
       - "LED1/LED5"  -> LED1,LED2,LED3,LED4,LED5
-    Restituisce una lista di nomi LED validi.
+    Restituisce una tupla (immutabile, è in cache) di nomi LED validi.
     Se l'espressione è vuota o non produce nulla, usa default_led.
     """
     expr = (expr or "").strip()
     leds = []
+    seen = set()
 
     if expr:
         # Spezza su virgole, spazi o ';'
-        tokens = re.split(r"[,\s;]+", expr)
+        tokens = _SPLIT_RE.split(expr)
         for tok in tokens:
             tok = tok.strip()
             if not tok:
@@ -149,34 +516,34 @@ def _expand_leds_expr(expr: str, default_led: str):
                 left = left.strip().upper()
                 right = right.strip().upper()
 
-                m1 = re.match(r"LED(\d+)$", left)
-                m2 = re.match(r"LED(\d+)$", right)
+                m1 = _LED_RE.match(left)
+                m2 = _LED_RE.match(right)
                 if m1 and m2:
                     n1 = int(m1.group(1))
                     n2 = int(m2.group(1))
-                    if n1 <= n2:
-                        rng = range(n1, n2 + 1)
-                    else:
-                        rng = range(n2, n1 + 1)
-                    for n in rng:
-                        name = f"LED{n}"
-                        if name in LED_NAMES and name not in leds:
+                    lo, hi = (n1, n2) if n1 <= n2 else (n2, n1)
+                    # solo i LED numerati che esistono: anche "LED1/LED99999"
+                    # costa al più len(_LED_NUMBERED) passi
+                    for n, name in _LED_NUMBERED:
+                        if lo <= n <= hi and name not in seen:
+                            seen.add(name)
                             leds.append(name)
                 # se non matcha il pattern, ignora questo token
             else:
                 # Singolo LED
                 name = tok.upper()
-                if name in LED_NAMES and name not in leds:
+                if name in _LED_SET and name not in seen:
+                    seen.add(name)
                     leds.append(name)
 
     if not leds:
         # Fallback: usa il LED singolo
-        if default_led in LED_NAMES:
-            return [default_led]
+        if default_led in _LED_SET:
+            return (default_led,)
         else:
-            return ["LED1"]
+            return ("LED1",)
 
-    return leds
+    return tuple(leds)
 
 
 # ---------------------------------------------------------------------------
@@ -190,6 +557,7 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
       - combo LED singolo: LED1, LED2, ...
       - linea "LEDs Expr": es. "LED1,LED2,LED3" o "LED1/LED5"
       - combo Invio: Tutti insieme / Sequenziale (caterpillar)
+      - combo Trasporto: TCP / UDP
       - combo Effect: Static / Blink / Fade / Rainbow
       - spinbox Delay (ms)
       - spinbox R: 0–255
@@ -197,19 +565,41 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
       - spinbox B: 0–255
     """
 
+    # (combo, attributo, valori nell'ordine delle voci): il primo è il default
+    _COMBO_FIELDS = (
+        ("side_combo", "led_side", ("BOTH", "LEFT", "RIGHT")),
+        ("led_combo", "led_name", tuple(LED_NAMES)),
+        ("mode_combo", "sequence_mode", ("BATCH", "SEQ")),  # tutti insieme / caterpillar
+        ("transport_combo", "transport", TRANSPORTS),
+        ("effect_combo", "effect_mode", tuple(EFFECT_CHOICES)),
+    )
+    # (spinbox, attributo intero)
+    _SPIN_FIELDS = (
+        ("delay_spin", "effect_delay_ms"),
+        ("r_spin", "color_r"),
+        ("g_spin", "color_g"),
+        ("b_spin", "color_b"),
+    )
+
     def __init__(self, action_data, parent=None):
         super().__init__(action_data, parent=parent)
 
     def _create_ui(self):
         layout = self.main_layout
 
+        # Le spinbox scattano a ogni tick (frecce, rotella, tasti): l'attributo
+        # si aggiorna subito, ma action_modified parte una volta sola a fine raffica
+        self._modified_timer = QtCore.QTimer(self)
+        self._modified_timer.setSingleShot(True)
+        self._modified_timer.setInterval(SPIN_DEBOUNCE_MS)
+        self._modified_timer.timeout.connect(self.action_modified.emit)
+
         # --- Riga Device (side) ---
         row_side = QtWidgets.QHBoxLayout()
         row_side.addWidget(QtWidgets.QLabel("Device"))
 
         self.side_combo = QtWidgets.QComboBox()
         self.side_combo.addItems(["BOTH", "LEFT", "RIGHT"])
-        self.side_combo.currentIndexChanged.connect(self._on_side_changed)
         row_side.addWidget(self.side_combo)
 
         row_side.addStretch()
@@ -221,7 +611,6 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
 
         self.led_combo = QtWidgets.QComboBox()
         self.led_combo.addItems(LED_NAMES)
-        self.led_combo.currentIndexChanged.connect(self._on_led_changed)
         row_led.addWidget(self.led_combo)
 
         row_led.addStretch()
@@ -245,19 +634,28 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
 
         self.mode_combo = QtWidgets.QComboBox()
         self.mode_combo.addItems(["Tutti insieme", "Sequenziale (caterpillar)"])
-        self.mode_combo.currentIndexChanged.connect(self._on_mode_changed)
         row_mode.addWidget(self.mode_combo)
 
         row_mode.addStretch()
         layout.addLayout(row_mode)
 
+        # --- Riga Trasporto (tcp/udp) ---
+        row_tr = QtWidgets.QHBoxLayout()
+        row_tr.addWidget(QtWidgets.QLabel("Trasporto"))
+
+        self.transport_combo = QtWidgets.QComboBox()
+        self.transport_combo.addItems(["TCP", "UDP"])
+        row_tr.addWidget(self.transport_combo)
+
+        row_tr.addStretch()
+        layout.addLayout(row_tr)
+
         # --- Riga Effect ---
         row_eff = QtWidgets.QHBoxLayout()
         row_eff.addWidget(QtWidgets.QLabel("Effect"))
 
         self.effect_combo = QtWidgets.QComboBox()
         self.effect_combo.addItems(["Static", "Blink", "Fade", "Rainbow"])
-        self.effect_combo.currentIndexChanged.connect(self._on_effect_changed)
         row_eff.addWidget(self.effect_combo)
 
         row_eff.addStretch()
@@ -270,7 +668,6 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
         self.delay_spin = QtWidgets.QSpinBox()
         self.delay_spin.setRange(0, 60000)
         self.delay_spin.setSingleStep(50)
-        self.delay_spin.valueChanged.connect(self._on_delay_changed)
         row_delay.addWidget(self.delay_spin)
 
         row_delay.addStretch()
@@ -283,7 +680,6 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
         self.r_spin = QtWidgets.QSpinBox()
         self.r_spin.setRange(0, 255)
         self.r_spin.setSingleStep(1)
-        self.r_spin.valueChanged.connect(self._on_r_changed)
         row_r.addWidget(self.r_spin)
 
         row_r.addStretch()
@@ -296,7 +692,6 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
         self.g_spin = QtWidgets.QSpinBox()
         self.g_spin.setRange(0, 255)
         self.g_spin.setSingleStep(1)
-        self.g_spin.valueChanged.connect(self._on_g_changed)
         row_g.addWidget(self.g_spin)
 
         row_g.addStretch()
@@ -309,7 +704,6 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
         self.b_spin = QtWidgets.QSpinBox()
         self.b_spin.setRange(0, 255)
         self.b_spin.setSingleStep(1)
-        self.b_spin.valueChanged.connect(self._on_b_changed)
         row_b.addWidget(self.b_spin)
 
         row_b.addStretch()
@@ -317,6 +711,14 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
 
         layout.setContentsMargins(0, 0, 0, 0)
 
+        # Collegamenti widget -> attributo dell'azione, da tabella
+        for widget_name, attr, values in self._COMBO_FIELDS:
+            getattr(self, widget_name).currentIndexChanged.connect(
+                lambda index, a=attr, v=values: self._commit_choice(a, v, index))
+        for widget_name, attr in self._SPIN_FIELDS:
+            getattr(self, widget_name).valueChanged.connect(
+                lambda value, a=attr: self._commit(a, value))
+
     def _populate_ui(self):
         """Carica i valori correnti dell'azione nella UI."""
 
@@ -328,11 +730,7 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
 
         # led singolo
         led_name = getattr(self.action_data, "led_name", "LED1")
-        try:
-            idx_led = LED_NAMES.index(led_name)
-        except ValueError:
-            idx_led = 0
-        self.led_combo.setCurrentIndex(idx_led)
+        self.led_combo.setCurrentIndex(_LED_INDEX.get(led_name, 0))
 
         # espressione
         expr = getattr(self.action_data, "leds_expr", "")
@@ -343,6 +741,10 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
         idx_mode = {"BATCH": 0, "SEQ": 1}.get(mode, 0)
         self.mode_combo.setCurrentIndex(idx_mode)
 
+        # trasporto
+        transport = getattr(self.action_data, "transport", "tcp")
+        self.transport_combo.setCurrentIndex(1 if transport == "udp" else 0)
+
         # effetto
         eff = getattr(self.action_data, "effect_mode", "STATIC").upper()
         idx_eff = {"STATIC": 0, "BLINK": 1, "FADE": 2, "RAINBOW": 3}.get(eff, 0)
@@ -357,56 +759,21 @@ class LedsBaseWidget(gremlin.ui.input_item.AbstractActionWidget):
         self.g_spin.setValue(int(getattr(self.action_data, "color_g", 0)))
         self.b_spin.setValue(int(getattr(self.action_data, "color_b", 0)))
 
-    def _on_side_changed(self, index: int):
-        value = self.side_combo.currentText() or "BOTH"
-        self.action_data.led_side = value.upper()
-        self.action_modified.emit()
-
-    def _on_led_changed(self, index: int):
-        if 0 <= index < len(LED_NAMES):
-            self.action_data.led_name = LED_NAMES[index]
-        else:
-            self.action_data.led_name = "LED1"
-        self.action_modified.emit()
-
     def _on_expr_changed(self):
         text = self.expr_edit.text().strip()
         self.action_data.leds_expr = text
         self.action_modified.emit()
 
-    def _on_mode_changed(self, index: int):
-        # 0 = BATCH (tutti insieme), 1 = SEQ (caterpillar)
-        self.action_data.sequence_mode = "SEQ" if index == 1 else "BATCH"
-        self.action_modified.emit()
-
-    def _on_effect_changed(self, index: int):
-        # Mappa indice -> STATIC/BLINK/FADE/RAINBOW
-        if index == 1:
-            eff = "BLINK"
-        elif index == 2:
-            eff = "FADE"
-        elif index == 3:
-            eff = "RAINBOW"
-        else:
-            eff = "STATIC"
-        self.action_data.effect_mode = eff
-        self.action_modified.emit()
-
-    def _on_delay_changed(self, value: int):
-        self.action_data.effect_delay_ms = int(value)
-        self.action_modified.emit()
-
-    def _on_r_changed(self, value: int):
-        self.action_data.color_r = int(value)
-        self.action_modified.emit()
-
-    def _on_g_changed(self, value: int):
-        self.action_data.color_g = int(value)
+    def _commit_choice(self, attr, values, index: int):
+        """Combo -> attributo: valore per indice, il primo se l'indice non è valido."""
+        setattr(self.action_data, attr,
+                values[index] if 0 <= index < len(values) else values[0])
         self.action_modified.emit()
 
-    def _on_b_changed(self, value: int):
-        self.action_data.color_b = int(value)
-        self.action_modified.emit()
+    def _commit(self, attr, value: int):
+        """Spinbox -> attributo; la notifica parte a fine raffica (vedi _modified_timer)."""
+        setattr(self.action_data, attr, int(value))
+        self._modified_timer.start()
 
 
 # ---------------------------------------------------------------------------
@@ -419,13 +786,47 @@ class LedsBaseFunctor(AbstractFunctor):
       - espande l'espressione LEDs Expr (se presente),
       - oppure usa solo led_name,
       - e invia i comandi secondo la modalità:
-        * BATCH: un'unica connessione con più righe (tutti insieme)
-        * SEQ:   una connessione per LED (caterpillar) con eventuale delay
+        * BATCH: un'unica scrittura con più righe (tutti insieme)
+        * SEQ:   come BATCH, ma ogni riga porta "AFTER i*delay" e il server
+                 accende i LED in sequenza (caterpillar)
+      sulla connessione TCP persistente verso il server, oppure via UDP
+      se l'azione usa transport="udp".
     """
 
     def __init__(self, action):
         super().__init__(action)
         self.action = action
+        self._revision = None
+        self._sync()
+
+    def _sync(self):
+        """Copia i parametri dell'azione in attributi locali (se sono cambiati)."""
+        action = self.action
+        revision = getattr(action, "revision", 0)
+        if revision == self._revision:
+            return
+        self._revision = revision
+
+        self._side = getattr(action, "led_side", "BOTH")
+        self._r = int(getattr(action, "color_r", 255))
+        self._g = int(getattr(action, "color_g", 0))
+        self._b = int(getattr(action, "color_b", 0))
+
+        self._effect = getattr(action, "effect_mode", "STATIC").upper()
+        self._delay = int(getattr(action, "effect_delay_ms", 0))
+
+        self._leds = getattr(action, "_leds_cached", None)
+        if self._leds is None:
+            self._leds = _expand_leds_expr_cached(
+                getattr(action, "leds_expr", ""), getattr(action, "led_name", "LED1"))
+        self._mode = getattr(action, "sequence_mode", "BATCH").upper()
+        self._transport = getattr(action, "transport", "tcp")
+
+        # SEQ: un solo batch, la cadenza (i * delay) la applica il server
+        # con il suffisso AFTER, senza sleep sul thread degli eventi
+        self._after_list = None
+        if self._mode == "SEQ" and self._delay > 0:
+            self._after_list = tuple(i * self._delay for i in range(len(self._leds)))
 
     def process_event(self, event, value):
         try:
@@ -433,50 +834,36 @@ class LedsBaseFunctor(AbstractFunctor):
         except AttributeError:
             etype = None
 
-        led_side = getattr(self.action, "led_side", "BOTH")
-        base_led = getattr(self.action, "led_name", "LED1")
-        expr = getattr(self.action, "leds_expr", "")
-
-        r = int(getattr(self.action, "color_r", 255))
-        g = int(getattr(self.action, "color_g", 0))
-        b = int(getattr(self.action, "color_b", 0))
-
-        effect = getattr(self.action, "effect_mode", "STATIC").upper()
-        delay_ms = int(getattr(self.action, "effect_delay_ms", 0))
-
-        leds = _expand_leds_expr(expr, base_led)
-        mode = getattr(self.action, "sequence_mode", "BATCH").upper()
-        sequential = (mode == "SEQ")
-
-        log.info(
-            f"[LEDs base] event={etype} side={led_side} leds={leds} "
-            f"rgb=({r},{g},{b}) effect={effect} delay={delay_ms}ms "
-            f"mode={'SEQ' if sequential else 'BATCH'} "
-            f"pressed={getattr(event, 'is_pressed', None)}"
-        )
+        self._sync()
+        led_side = self._side
+        leds = self._leds
+        r, g, b = self._r, self._g, self._b
+        effect = self._effect
+        delay_ms = self._delay
+        after_list = self._after_list
+
+        # percorso caldo: niente formattazione se il DEBUG è spento
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "[LEDs base] event=%s side=%s leds=%s rgb=(%d,%d,%d) "
+                "effect=%s delay=%dms mode=%s pressed=%s",
+                etype, led_side, leds, r, g, b, effect, delay_ms,
+                "SEQ" if self._mode == "SEQ" else "BATCH",
+                getattr(event, "is_pressed", None),
+            )
 
         if not leds:
             return False
 
         # Per pulsanti / tastiera: solo on-press
-        if etype in [InputType.JoystickButton, InputType.Keyboard]:
+        if etype in _PRESS_ONLY_TYPES:
             if getattr(event, "is_pressed", False):
-                if sequential:
-                    for i, led_name in enumerate(leds):
-                        _send_led(led_side, led_name, r, g, b, effect, delay_ms)
-                        if i < len(leds) - 1 and delay_ms > 0:
-                            time.sleep(delay_ms / 1000.0)
-                else:
-                    _send_leds_batch(led_side, leds, r, g, b, effect, delay_ms)
+                _send_leds_batch(led_side, leds, r, g, b, effect, delay_ms,
+                                 after_list=after_list, transport=self._transport)
         else:
             # Altri tipi (asse / hat): invia sempre
-            if sequential:
-                for i, led_name in enumerate(leds):
-                    _send_led(led_side, led_name, r, g, b, effect, delay_ms)
-                    if i < len(leds) - 1 and delay_ms > 0:
-                        time.sleep(delay_ms / 1000.0)
-            else:
-                _send_leds_batch(led_side, leds, r, g, b, effect, delay_ms)
+            _send_leds_batch(led_side, leds, r, g, b, effect, delay_ms,
+                             after_list=after_list, transport=self._transport)
 
         return True
 
@@ -491,6 +878,7 @@ class LedsBase(AbstractAction):
         - led_name (LED1, LED2, ..., LED10, LED11)
         - leds_expr (es. "LED1,LED2" o "LED1/LED5")
         - sequence_mode: BATCH / SEQ
+        - transport: tcp / udp
         - effect_mode: STATIC / BLINK / FADE / RAINBOW
         - effect_delay_ms: delay / periodo in millisecondi
         - color_r (0–255)
@@ -502,39 +890,53 @@ class LedsBase(AbstractAction):
     tag = "leds-base-rg"
 
     default_button_activation = (True, True)
-    input_types = [
+    input_types = (
         InputType.JoystickAxis,
         InputType.JoystickButton,
         InputType.JoystickHat,
         InputType.Keyboard,
-    ]
+    )
 
     functor = LedsBaseFunctor
     widget = LedsBaseWidget
 
+    # Parametri letti dal functor: ogni modifica incrementa `revision`,
+    # così il functor sa quando ricopiarli (vedi LedsBaseFunctor._sync)
+    _CONFIG_FIELDS = frozenset((
+        "led_side", "led_name", "leds_expr", "sequence_mode", "transport",
+        "effect_mode", "effect_delay_ms", "color_r", "color_g", "color_b",
+    ))
+
     def __init__(self, parent):
+        self.revision = 0
         super().__init__(parent)
         self.led_side = "BOTH"
         self.led_name = "LED1"
         self.leds_expr = ""      # vuoto = usa solo led_name
         self.sequence_mode = "BATCH"  # BATCH = tutti insieme, SEQ = caterpillar
+        self.transport = "tcp"        # tcp = connessione persistente, udp = datagrammi
         self.effect_mode = "STATIC"
         self.effect_delay_ms = 0
         self.color_r = 255
         self.color_g = 0
         self.color_b = 0
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self._CONFIG_FIELDS:
+            super().__setattr__("revision", self.revision + 1)
+            if name in ("leds_expr", "led_name"):
+                # lista LED espansa una volta sola, quando cambia la configurazione
+                super().__setattr__("_leds_cached", _expand_leds_expr_cached(
+                    self.__dict__.get("leds_expr", ""),
+                    self.__dict__.get("led_name", "LED1"),
+                ))
+
     def icon(self):
         return "{}/icon.png".format(os.path.dirname(os.path.realpath(__file__)))
 
     def requires_virtual_button(self):
-        input_type = self.get_input_type()
-        if input_type in [InputType.JoystickButton, InputType.Keyboard]:
-            return False
-        elif input_type == InputType.JoystickAxis:
-            return True
-        elif input_type == InputType.JoystickHat:
-            return True
+        return _VB_TABLE.get(self.get_input_type(), False)
 
     # ---------- XML ----------
 
@@ -546,7 +948,7 @@ class LedsBase(AbstractAction):
 
         # led singolo
         led = node.get("led", "LED1")
-        self.led_name = led if led in LED_NAMES else "LED1"
+        self.led_name = led if led in _LED_SET else "LED1"
 
         # espressione
         self.leds_expr = node.get("expr", "")
@@ -557,6 +959,12 @@ class LedsBase(AbstractAction):
             mode = "BATCH"
         self.sequence_mode = mode
 
+        # transport
+        transport = (node.get("transport", "tcp") or "tcp").lower()
+        if transport not in TRANSPORTS:
+            transport = "tcp"
+        self.transport = transport
+
         # effect
         eff = node.get("effect", "STATIC").upper()
         if eff not in EFFECT_CHOICES:
@@ -589,17 +997,19 @@ class LedsBase(AbstractAction):
 
     def _generate_xml(self):
         """Salva i parametri in XML."""
-        node = ElementTree.Element("leds-base-rg")
-        node.set("side", self.led_side)
-        node.set("led", self.led_name)
-        node.set("expr", self.leds_expr or "")
-        node.set("mode", self.sequence_mode or "BATCH")
-        node.set("effect", self.effect_mode or "STATIC")
-        node.set("delay", str(int(self.effect_delay_ms)))
-        node.set("r", str(int(self.color_r)))
-        node.set("g", str(int(self.color_g)))
-        node.set("b", str(int(self.color_b)))
-        return node
+        # tutti gli attributi in un solo aggiornamento del dizionario
+        return ElementTree.Element("leds-base-rg", {
+            "side": self.led_side,
+            "led": self.led_name,
+            "expr": self.leds_expr or "",
+            "mode": self.sequence_mode or "BATCH",
+            "transport": self.transport or "tcp",
+            "effect": self.effect_mode or "STATIC",
+            "delay": str(int(self.effect_delay_ms)),
+            "r": str(int(self.color_r)),
+            "g": str(int(self.color_g)),
+            "b": str(int(self.color_b)),
+        })
 
     def _is_valid(self):
         return bool(self.led_name)